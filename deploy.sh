@@ -10,6 +10,8 @@ PLATFORM_ID="standard-v3"                   # Платформа
 CORES=2                                     # Количество ядер
 MEMORY=4GB                                  # Объем памяти в ГБ
 DISK_SIZE=30                                # Размер диска в ГБ
+DATA_DISK_NAME="${VM_NAME}-data"            # Диск с данными бота, переживает пересоздание VM
+DATA_DISK_SIZE=10                           # Размер диска с данными в ГБ
 DOCKER_COMPOSE_PATH="./.docker-compose.cloud.yml"
 SSH_KEY_PATH=~/.ssh/id_ed25519.pub
 
@@ -66,7 +68,17 @@ if yc compute instance get ${VM_NAME} > /dev/null 2>&1; then
     fi
 fi
 
+# Создание диска с данными, если его еще нет (снапшоты состояния, профили, напоминания)
+if ! yc compute disk get ${DATA_DISK_NAME} > /dev/null 2>&1; then
+    echo "Creating data disk ${DATA_DISK_NAME}..."
+    yc compute disk create \
+      --name ${DATA_DISK_NAME} \
+      --zone ${ZONE} \
+      --size ${DATA_DISK_SIZE}
+fi
+
 # Создание VM с Container Solution
+# Диск с данными подключается с auto-delete=false, поэтому --reset удаляет только загрузочный диск
 yc compute instance create-with-container \
   --name ${VM_NAME} \
   --zone ${ZONE} \
@@ -75,6 +87,7 @@ yc compute instance create-with-container \
   --ssh-key ${SSH_KEY_PATH} \
   --platform-id ${PLATFORM_ID} \
   --create-boot-disk size=${DISK_SIZE} \
+  --attach-disk disk-name=${DATA_DISK_NAME},device-name=bot-data,auto-delete=false \
   --network-interface subnet-id=${SUBNET_ID},nat-ip-version=ipv4 \
   --service-account-id ${SERVICE_ACCOUNT_ID} \
   --docker-compose-file ${DOCKER_COMPOSE_PATH}
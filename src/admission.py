@@ -0,0 +1,147 @@
+import asyncio
+import heapq
+import itertools
+from collections import Counter
+from enum import Enum
+from typing import Dict, List, Optional, Tuple
+from config import logger, COMMAND_COSTS, STATE_COSTS, ADMISSION_LIMITS, ADMISSION_USER_LIMIT
+from routing import COMMANDS, CommandName
+
+CHEAP = "cheap"
+
+# Costs keyed by the command enum of the precomputed route
+COMMAND_NAME_COSTS = {COMMANDS[name]: cost for name, cost in COMMAND_COSTS.items()}
+
+
+class Admission(Enum):
+    """Result of admission control"""
+    ADMITTED = "admitted"
+    BUSY = "busy"  # the cost class is overloaded, request is shed
+    QUOTA = "quota"  # the user already has a request of this class in progress
+
+
+class PriorityLimiter:  # pylint: disable=too-many-instance-attributes (R0902)
+    """Concurrency limiter with a bounded priority queue of waiting requests"""
+    def __init__(self, name: str, concurrency: int, max_queue: int, timeout: float):
+        self.name = name
+        self.concurrency = concurrency
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self.active = 0
+        self.shed = 0  # number of rejected requests
+        self._waiters: List[Tuple[int, int, asyncio.Future]] = []  # (priority, sequence, future)
+        self._seq = itertools.count()
+
+    @property
+    def queued(self) -> int:
+        """Number of waiting requests"""
+        return len(self._waiters)
+
+    async def acquire(self, priority: int = 0) -> bool:
+        """Waits for a free slot. Returns False if the request is shed"""
+        if self.active < self.concurrency and not self._waiters:
+            self.active += 1
+            return True
+        if len(self._waiters) >= self.max_queue:
+            self.shed += 1
+            return False
+
+        entry = (priority, next(self._seq), asyncio.get_running_loop().create_future())
+        heapq.heappush(self._waiters, entry)
+        fut = entry[2]
+        try:
+            await asyncio.wait_for(fut, self.timeout)
+            return True
+        except asyncio.TimeoutError:
+            # The slot could have been handed over right at the timeout
+            if fut.done() and not fut.cancelled():
+                return True
+            self._remove(entry)
+            self.shed += 1
+            return False
+        except asyncio.CancelledError:
+            if fut.done() and not fut.cancelled():
+                self.release()
+            else:
+                self._remove(entry)
+            raise
+
+    def _remove(self, entry: Tuple[int, int, asyncio.Future]):
+        if entry in self._waiters:
+            self._waiters.remove(entry)
+            heapq.heapify(self._waiters)
+
+    def release(self):
+        """Hands the slot over to the next waiting request or frees it"""
+        while self._waiters:
+            _, _, fut = heapq.heappop(self._waiters)
+            # Waiters that timed out or were cancelled stay in the heap until their task runs again
+            if not fut.done():
+                fut.set_result(None)
+                return
+        self.active -= 1
+
+
+class AdmissionController:
+    """
+    Admission control in front of handlers.
+    Requests are split into cost classes with separate concurrency limits, so expensive
+    commands can't starve cheap ones. Expensive requests wait in a priority queue and are
+    shed when the queue is full or the wait is too long. A user may have only a limited
+    number of expensive requests in progress.
+    """
+    def __init__(self, limits: Dict[str, Tuple[int, int, float]] = None, user_limit: int = ADMISSION_USER_LIMIT):
+        limits = limits or ADMISSION_LIMITS
+        self._limiters = {name: PriorityLimiter(name, *limit) for name, limit in limits.items()}
+        self.user_limit = user_limit
+        self._user_load: Counter = Counter()  # (cost class, user_id) -> requests in progress or queued
+
+    @staticmethod
+    def classify(command: Optional[CommandName], raw_state: Optional[str]) -> Tuple[str, int]:
+        """Returns cost class and priority of a message by its command or FSM state"""
+        if command is not None:
+            return COMMAND_NAME_COSTS.get(command, (CHEAP, 0))
+        if raw_state is not None:
+            return STATE_COSTS.get(raw_state, (CHEAP, 0))
+        return CHEAP, 0
+
+    async def acquire(self, cost: str, priority: int, user_id: int) -> Admission:
+        """Admits a request or tells why it is rejected. Admitted requests must be released"""
+        if cost != CHEAP:
+            if self._user_load[cost, user_id] >= self.user_limit:
+                return Admission.QUOTA
+            self._user_load[cost, user_id] += 1
+
+        limiter = self._limiters[cost]
+        try:
+            admitted = await limiter.acquire(priority)
+        except asyncio.CancelledError:
+            self._release_user(cost, user_id)
+            raise
+        if admitted:
+            return Admission.ADMITTED
+
+        logger.warning(
+            "Shedding %s request of user %s: %s active, %s queued", cost, user_id, limiter.active, limiter.queued
+        )
+        self._release_user(cost, user_id)
+        return Admission.BUSY
+
+    def release(self, cost: str, user_id: int):
+        """Releases an admitted request"""
+        self._limiters[cost].release()
+        self._release_user(cost, user_id)
+
+    def _release_user(self, cost: str, user_id: int):
+        if cost == CHEAP:
+            return
+        self._user_load[cost, user_id] -= 1
+        if self._user_load[cost, user_id] <= 0:
+            del self._user_load[cost, user_id]
+
+    def stats(self) -> Dict[str, Dict[str, int]]:
+        """Returns load of each cost class"""
+        return {
+            name: {"active": limiter.active, "queued": limiter.queued, "shed": limiter.shed}
+            for name, limiter in self._limiters.items()
+        }
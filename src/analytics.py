@@ -0,0 +1,218 @@
+import asyncio
+import time
+from collections import Counter
+from dataclasses import dataclass, field
+from typing import TYPE_CHECKING, Dict, Iterable, Iterator, List, Optional, Set, Tuple
+import numpy as np
+from config import logger, ANALYTICS_INTERVAL, ANALYTICS_WINDOW_DAYS, ANALYTICS_TOP_FOODS
+from day_index import MIN_UTC_OFFSET, MAX_UTC_OFFSET, current_day, day_iso
+from models import DailyStats, UserProfile
+
+if TYPE_CHECKING:
+    from profile_cache import ProfileCache
+
+# Last counted stats of a user for a day, one row per user index
+ROW_DTYPE = np.dtype([
+    ("counted", np.bool_),  # user has stats for the day
+    ("logged_water", np.float32),
+    ("water_goal", np.float32),
+    ("logged_calories", np.float32),
+    ("burned_calories", np.float32),
+    ("calorie_goal_met", np.bool_),  # intake didn't exceed BMR + burned calories
+    ("foods", np.uint32),  # food log entries counted in the day's food counter
+    ("workouts", np.uint32),  # workout log entries counted in the day's workout counter
+])
+
+
+@dataclass
+class DayAggregate:
+    """Stats of all users for a single day: a column row per user and counters of logged foods and workouts"""
+    day: int  # day number
+    rows: np.ndarray  # ROW_DTYPE array indexed by user index
+    foods: Counter = field(default_factory=Counter)  # food name -> times logged
+    workouts: Counter = field(default_factory=Counter)  # workout type -> minutes
+
+    def update(self, row: int, stats: Optional[DailyStats]):
+        """Replaces the counted stats of the user in the row with new ones (None if the user has no stats)"""
+        foods = int(self.rows["foods"][row])
+        workouts = int(self.rows["workouts"][row])
+        if stats is None:
+            # Logs already counted stay in the counters
+            self.rows[row] = (False, 0, 0, 0, 0, False, foods, workouts)
+            return
+
+        # Logs are append-only, so only entries added since the last update are counted
+        new_foods = stats.food_log[foods:]
+        new_workouts = stats.workout_log[workouts:]
+        self.foods.update(log["name"].strip().lower() for log in new_foods)
+        for log in new_workouts:
+            self.workouts[log["type"]] += log["duration"]
+        self.rows[row] = (
+            True,
+            stats.logged_water,
+            stats.water_goal,
+            stats.logged_calories,
+            stats.burned_calories,
+            0 < stats.logged_calories <= stats.calorie_goal + stats.burned_calories,
+            foods + len(new_foods),
+            workouts + len(new_workouts),
+        )
+
+
+class AnalyticsTable:
+    """
+    Precomputed cross-user aggregates.
+    Aggregates are kept per day (in users' local dates) as columns with a row per user.
+    They are built from all profiles once at startup, after that only user days reported
+    as changed by the state store are recounted. Counting and the vectorized summary run
+    in a worker thread, the report only formats the summary.
+    """
+    def __init__(self, profiles: "ProfileCache", window_days: int = ANALYTICS_WINDOW_DAYS):
+        self._profiles = profiles
+        self.window_days = window_days
+        self._days: Dict[int, DayAggregate] = {}
+        self._rows: Dict[int, int] = {}  # user_id -> row index
+        self._offsets = np.zeros(1024, dtype=np.int32)  # UTC offset of each row's user
+        self._dirty: Dict[int, Set[int]] = {}  # user_id -> day numbers changed since the last update
+        self.summary: Optional[Dict] = None
+
+    def mark_dirty(self, user_id: int, days: Iterable[int]):
+        """Marks user stats of the given day numbers as changed"""
+        self._dirty.setdefault(user_id, set()).update(days)
+
+    async def refresh(self, now: float):
+        """Builds aggregates on the first call, after that recounts changed user days"""
+        dirty, self._dirty = self._dirty, {}
+        # Changed profiles were just used by handlers, so they are almost always in memory.
+        # Others are read from the storage in the thread
+        changed = [(user_id, days, self._profiles.peek(user_id)) for user_id, days in dirty.items()]
+        # Updates are idempotent, so users changed during the build may be counted twice
+        profiles = self._profiles.iter_all() if self.summary is None else None
+        try:
+            self.summary = await asyncio.to_thread(self._update, profiles, changed, now)
+        except Exception:
+            for user_id, days in dirty.items():
+                self.mark_dirty(user_id, days)  # recount them on the next refresh
+            raise
+
+    def _update(
+            self,
+            profiles: Optional[Iterator[UserProfile]],
+            changed: List[Tuple[int, Set[int], Optional[UserProfile]]],
+            now: float
+    ) -> Dict:
+        """Moves the window, counts profiles and changed user days, returns the summary. Blocking"""
+        # The latest day is the current one in the easternmost timezone
+        first, last = current_day(0, now) - self.window_days + 1, current_day(MAX_UTC_OFFSET, now)
+        for day in [day for day in self._days if day < first]:
+            del self._days[day]
+        for day in range(first, last + 1):
+            if day not in self._days:
+                self._days[day] = DayAggregate(day=day, rows=np.zeros(len(self._offsets), dtype=ROW_DTYPE))
+
+        for profile in profiles or ():
+            row = self._row(profile)
+            for stats in profile.daily_stats.range(first, last + 1):
+                self._days[stats.day].update(row, stats)
+
+        for user_id, days, profile in changed:
+            if profile is None:
+                profile = self._profiles.load_stored(user_id)
+                if profile is None:
+                    continue
+            row = self._row(profile)
+            for day in days:
+                if day in self._days:
+                    self._days[day].update(row, profile.daily_stats.get(day))
+
+        return self._summarize(now)
+
+    def _row(self, profile: UserProfile) -> int:
+        """Returns the row index of the user, adding a row for a new one"""
+        row = self._rows.get(profile.user_id)
+        if row is None:
+            row = self._rows[profile.user_id] = len(self._rows)
+            if row == len(self._offsets):
+                self._grow(2 * row)
+        self._offsets[row] = profile.utc_offset
+        return row
+
+    def _grow(self, size: int):
+        extra = size - len(self._offsets)
+        self._offsets = np.concatenate([self._offsets, np.zeros(extra, dtype=np.int32)])
+        for aggregate in self._days.values():
+            aggregate.rows = np.concatenate([aggregate.rows, np.zeros(extra, dtype=ROW_DTYPE)])
+
+    def _summarize(self, now: float) -> Dict:
+        aggregates = list(self._days.values())
+        user_days = sum(int(np.count_nonzero(a.rows["counted"])) for a in aggregates)
+
+        def total(column: str) -> float:
+            return sum(float(a.rows[column].sum(dtype=np.float64)) for a in aggregates)
+
+        water_goal_met = sum(
+            int(np.count_nonzero((a.rows["water_goal"] > 0) & (a.rows["logged_water"] >= a.rows["water_goal"])))
+            for a in aggregates
+        )
+        foods = Counter()
+        workouts = Counter()
+        for a in aggregates:
+            foods.update(a.foods)
+            workouts.update(a.workouts)
+
+        # Users who logged something on their own local today, which is one of the current days across timezones
+        local_days = current_day(self._offsets.astype(np.int64), now)
+        active_today = sum(
+            int(np.count_nonzero(self._days[day].rows["counted"] & (local_days == day)))
+            for day in range(current_day(MIN_UTC_OFFSET, now), current_day(MAX_UTC_OFFSET, now) + 1)
+        )
+        return {
+            "date": day_iso(current_day(0, now)),
+            "days": self.window_days,
+            "users": len(self._profiles),
+            "active_today": active_today,
+            "user_days": user_days,
+            "avg_water": total("logged_water") / user_days if user_days else 0,
+            "avg_calories": total("logged_calories") / user_days if user_days else 0,
+            "avg_burned": total("burned_calories") / user_days if user_days else 0,
+            "water_adherence": water_goal_met / user_days if user_days else 0,
+            "calorie_adherence": total("calorie_goal_met") / user_days if user_days else 0,
+            "top_foods": foods.most_common(ANALYTICS_TOP_FOODS),
+            "workout_minutes": dict(workouts.most_common()),
+        }
+
+    async def run(self, interval: float = ANALYTICS_INTERVAL):
+        """Refreshes aggregates periodically until cancelled"""
+        while True:
+            try:
+                await self.refresh(time.time())
+            except Exception as e:
+                logger.error("Error refreshing analytics: %s", e)
+            await asyncio.sleep(interval)
+
+    def report(self) -> str:
+        """Formats the precomputed summary"""
+        summary = self.summary
+        if summary is None:
+            return "Analytics are not ready yet, try again later."
+
+        report = f"📈 Analytics for the last {summary['days']} days (as of {summary['date']}):\n\n"
+        report += f"👥 Users: {summary['users']}, active today: {summary['active_today']}\n"
+        report += f"📅 Active user-days: {summary['user_days']}\n\n"
+        report += f"💧 Average water: {summary['avg_water']:.0f} ml/day\n"
+        report += f"🔥 Average calories: {summary['avg_calories']:.0f} kcal/day\n"
+        report += f"💪 Average burned: {summary['avg_burned']:.0f} kcal/day\n\n"
+        report += f"🎯 Water goal reached: {summary['water_adherence']:.0%} of user-days\n"
+        report += f"🎯 Calories within goal: {summary['calorie_adherence']:.0%} of user-days\n"
+
+        if summary["top_foods"]:
+            report += "\n🍽 Popular foods:\n"
+            for name, count in summary["top_foods"]:
+                report += f"- {name}: {count}\n"
+
+        total_minutes = sum(summary["workout_minutes"].values())
+        if total_minutes:
+            report += "\n🏃‍♂️ Workout mix:\n"
+            for workout_type, minutes in summary["workout_minutes"].items():
+                report += f"- {workout_type.capitalize()}: {minutes} min ({minutes / total_minutes:.0%})\n"
+        return report
@@ -1,13 +1,30 @@
-from datetime import datetime, timedelta
+from datetime import datetime
 import asyncio
+import os
+import time
 from aiogram import Bot, Dispatcher, Router, BaseMiddleware
-from aiogram.types import Message, BufferedInputFile
-from aiogram.filters import Command, CommandObject
+from aiogram.types import (
+    Update, Message, BufferedInputFile, FSInputFile, KeyboardButton, ReplyKeyboardMarkup, ReplyKeyboardRemove
+)
+from aiogram.filters import CommandObject
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
-from config import BOT_TOKEN, WATER_PER_WORKOUT, WEATHER_API_KEY, WORKOUT_CALORIES, logger
-from models import UserProfile
-from utils import get_temperature, generate_progress_charts, get_food_info_from_fs
+from config import (
+    BOT_TOKEN, WATER_PER_WORKOUT, WEATHER_API_KEY, WORKOUT_CALORIES, ADMIN_IDS, EXPORT_MAX_DOCUMENT_SIZE, SIMULATION,
+    PROFILE_SETUP_TTL, logger
+)
+from models import UserProfile, recompute_goals
+from day_index import day_date
+from delivery import DeliveryQueue
+from reminders import ReminderScheduler
+from analytics import AnalyticsTable
+from food_index import FoodSuggestions
+from snapshot import StateStore
+from profile_cache import ProfileCache, ProfileStorage
+from routing import CommandName, Route, RouteCommand, classify_message, state_group
+from admission import Admission, AdmissionController
+from export import EXPORT_FORMATS, export_records, iter_profile_records, iter_records
+from utils import get_weather, generate_progress_charts, get_food_info_from_fs
 
 
 # FSM states for profile setup
@@ -47,38 +64,94 @@ class HistoryPeriod(StatesGroup):  # pylint: disable=too-few-public-methods (R09
     waiting_for_period = State()
 
 
-# User data storage
-users: dict[int, UserProfile] = {}
+# User data storage, only recently active profiles are kept in memory
+profiles = ProfileCache(ProfileStorage())
+
+# Snapshots and change journal of users and FSM state
+store = StateStore(profiles)
+
+# Concurrency limits for expensive commands
+admission = AdmissionController()
+
+# Outgoing messages are delivered in background respecting Telegram rate limits
+outbox = DeliveryQueue()
+
+# Proactive water reminders
+reminders = ReminderScheduler(profiles, outbox)
+outbox.on_unreachable(reminders.cancel)
+
+# Cross-user aggregates for administrators
+analytics = AnalyticsTable(profiles)
+store.subscribe(analytics.mark_dirty)
+
+# Recently logged foods for suggestions and lookups without FatSecret requests
+food_suggestions = FoodSuggestions()
 
 router = Router()
 
 
-# Middleware for checking user profile existence
-class CheckUserProfileMiddleware(BaseMiddleware):  # pylint: disable=too-few-public-methods (R0903)
-    """Middleware for checking user profile existence"""
-    async def __call__(self, handler, event: Message, data: dict):
-        user_id = event.from_user.id
+# Users who started profile setup and don't have a profile yet -> setup start time, oldest first
+pending_profiles: dict[int, float] = {}
+
+
+def add_pending_profile(user_id: int):
+    """Remembers a user who started profile setup and forgets abandoned setups"""
+    now = time.monotonic()
+    pending_profiles.pop(user_id, None)  # keep the dict ordered by start time
+    pending_profiles[user_id] = now
+    expired = now - PROFILE_SETUP_TTL
+    while pending_profiles:
+        oldest = next(iter(pending_profiles))
+        if pending_profiles[oldest] >= expired:
+            break
+        del pending_profiles[oldest]
 
-        # List of commands allowed without profile
-        allowed_commands = ['/set_profile', '/start', '/help']
 
-        # Skip if command is allowed or state is "profile setup"
-        if (
-                (event.text and any(event.text.startswith(cmd) for cmd in allowed_commands)) or
-                isinstance(data.get('state'), ProfileSetup) or data.get('raw_state') is not None
-                and data['raw_state'].startswith('ProfileSetup')
-           ):
+def is_setting_up_profile(user_id: int) -> bool:
+    """Checks if the user started profile setup less than `PROFILE_SETUP_TTL` seconds ago"""
+    started = pending_profiles.get(user_id)
+    return started is not None and time.monotonic() - started < PROFILE_SETUP_TTL
 
+
+# Update middleware for classifying messages, registered before the FSM middleware
+class ClassifyUpdateMiddleware(BaseMiddleware):  # pylint: disable=too-few-public-methods (R0903)
+    """Middleware for parsing the command and checking user profile existence once per update"""
+    async def __call__(self, handler, event: Update, data: dict):
+        message = event.message
+        if message is None or message.from_user is None:
             return await handler(event, data)
 
-        # Check if profile exists
-        if user_id not in users:
-            await event.answer("Please set up your profile first using /set_profile")
-            return
+        user_id = message.from_user.id
+        me = await data['bot'].me()  # cached by the bot after the first request
+        route = classify_message(message.text, user_id in profiles, me.username)
 
+        # Users without profile are rejected before their FSM state is loaded
+        if not route.has_profile and not route.allowed_without_profile and not is_setting_up_profile(user_id):
+            outbox.answer(message, "Please set up your profile first using /set_profile")
+            return None
+
+        data['route'] = route
         return await handler(event, data)
 
 
+# Update middleware for adding the FSM state to the route, registered after the FSM middleware
+class ClassifyStateMiddleware(BaseMiddleware):  # pylint: disable=too-few-public-methods (R0903)
+    """Middleware for adding the FSM state loaded by the FSM middleware to the route"""
+    async def __call__(self, handler, event: Update, data: dict):
+        route: Route | None = data.get('route')
+        if route is not None:
+            route.state = data.get('raw_state')
+        return await handler(event, data)
+
+
+def setup_middleware(dp: Dispatcher):
+    """Registers the classifying middlewares around the FSM middleware of the dispatcher"""
+    dp.update.outer_middleware.unregister(dp.fsm)
+    dp.update.outer_middleware(ClassifyUpdateMiddleware())
+    dp.update.outer_middleware(dp.fsm)
+    dp.update.outer_middleware(ClassifyStateMiddleware())
+
+
 # Middleware for logging
 class LoggingMiddleware(BaseMiddleware):  # pylint: disable=too-few-public-methods (R0903)
     """Middleware for logging"""
@@ -87,15 +160,61 @@ class LoggingMiddleware(BaseMiddleware):  # pylint: disable=too-few-public-metho
         return await handler(event, data)
 
 
+# Middleware for journaling changes made by handlers
+class StateJournalMiddleware(BaseMiddleware):  # pylint: disable=too-few-public-methods (R0903)
+    """Middleware for journaling profile changes"""
+    async def __call__(self, handler, event: Message, data: dict):
+        user_id = event.from_user.id
+        profile = profiles.peek(user_id)
+        day = profile.today() if profile is not None else None
+        # Profile must not be evicted while the handler awaits external APIs, its changes would be lost
+        profiles.pin(user_id)
+        try:
+            return await handler(event, data)
+        finally:
+            profiles.unpin(user_id)
+            profile = profiles.peek(user_id)
+            if profile is not None:
+                # Handler could have crossed midnight or changed the timezone, mark both days
+                days = {profile.today()}
+                if day is not None:
+                    days.add(day)
+                store.mark_dirty(user_id, days)
+                profiles.mark_dirty(user_id)
+                reminders.resume(user_id)
+
+
+# Middleware for admission control of expensive commands
+class AdmissionMiddleware(BaseMiddleware):  # pylint: disable=too-few-public-methods (R0903)
+    """Middleware for limiting concurrency of expensive commands"""
+    async def __call__(self, handler, event: Message, data: dict):
+        user_id = event.from_user.id
+        route: Route = data['route']
+        cost, priority = admission.classify(route.command, route.state)
+        result = await admission.acquire(cost, priority, user_id)
+        if result is Admission.QUOTA:
+            outbox.answer(event, "⏳ Your previous request is still being processed, please wait.")
+            return
+        if result is Admission.BUSY:
+            outbox.answer(event, "⏳ The bot is busy right now, please try again in a minute.")
+            return
+        try:
+            return await handler(event, data)
+        finally:
+            admission.release(cost, user_id)
+
+
 # Register middleware
 router.message.middleware(LoggingMiddleware())
-router.message.middleware(CheckUserProfileMiddleware())
+router.message.middleware(AdmissionMiddleware())
+router.message.middleware(StateJournalMiddleware())
 
 
-@router.message(Command("start"))
+@router.message(RouteCommand(CommandName.START))
 async def cmd_start(message: Message):
     """Starts the bot"""
-    await message.answer(
+    outbox.answer(
+        message,
         "Hi! I'll help you track your water and calorie intake.\n"
         "Use the following commands:\n"
         "/set_profile - set up profile 👤\n"
@@ -104,15 +223,18 @@ async def cmd_start(message: Message):
         "/log_workout <type> <minutes> - log workout 🏃‍♂️\n"
         "/check_progress - check progress 🏁\n"
         "/charts - show progress charts 📊\n"
-        "/history - show activity history 📅"
+        "/history - show activity history 📅\n"
+        "/export [csv|jsonl|parquet] - export your data 📦"
     )
 
 
-@router.message(Command("set_profile"))
+@router.message(RouteCommand(CommandName.SET_PROFILE))
 async def cmd_set_profile(message: Message, state: FSMContext):
     """Sets up the user profile"""
     await state.set_state(ProfileSetup.weight)
-    await message.answer("Enter your weight (kg):")
+    if message.from_user.id not in profiles:
+        add_pending_profile(message.from_user.id)
+    outbox.answer(message, "Enter your weight (kg):")
 
 
 @router.message(ProfileSetup.weight)
@@ -122,9 +244,9 @@ async def process_weight(message: Message, state: FSMContext):
         weight = float(message.text)
         await state.update_data(weight=weight)
         await state.set_state(ProfileSetup.height)
-        await message.answer("Enter your height (cm):")
+        outbox.answer(message, "Enter your height (cm):")
     except ValueError:
-        await message.answer("Please enter a number. Try again:")
+        outbox.answer(message, "Please enter a number. Try again:")
 
 
 @router.message(ProfileSetup.height)
@@ -134,9 +256,9 @@ async def process_height(message: Message, state: FSMContext):
         height = float(message.text)
         await state.update_data(height=height)
         await state.set_state(ProfileSetup.age)
-        await message.answer("Enter your age:")
+        outbox.answer(message, "Enter your age:")
     except ValueError:
-        await message.answer("Please enter a number. Try again:")
+        outbox.answer(message, "Please enter a number. Try again:")
 
 
 @router.message(ProfileSetup.age)
@@ -146,9 +268,9 @@ async def process_age(message: Message, state: FSMContext):
         age = int(message.text)
         await state.update_data(age=age)
         await state.set_state(ProfileSetup.activity)
-        await message.answer("How many minutes of activity do you have per day?")
+        outbox.answer(message, "How many minutes of activity do you have per day?")
     except ValueError:
-        await message.answer("Please enter a whole number. Try again:")
+        outbox.answer(message, "Please enter a whole number. Try again:")
 
 
 @router.message(ProfileSetup.activity)
@@ -158,9 +280,9 @@ async def process_activity(message: Message, state: FSMContext):
         activity = int(message.text)
         await state.update_data(activity=activity)
         await state.set_state(ProfileSetup.city)
-        await message.answer("What city are you in?")
+        outbox.answer(message, "What city are you in?")
     except ValueError:
-        await message.answer("Please enter a whole number of minutes. Try again:")
+        outbox.answer(message, "Please enter a whole number of minutes. Try again:")
 
 
 @router.message(ProfileSetup.city)
@@ -181,20 +303,30 @@ async def process_city(message: Message, state: FSMContext):
     )
 
     try:
-        # Get temperature for water norm calculation
-        temp = await get_temperature(city, WEATHER_API_KEY)
-        if temp is None:
+        # Get temperature for water norm calculation and the city timezone for day boundaries
+        weather = await get_weather(city, WEATHER_API_KEY)
+        if weather is None:
             raise ValueError("Failed to get temperature")
+        temp = profile.apply_weather(weather)
+
+        # Keep logged history when the profile is edited
+        existing = await profiles.get(user_id)
+        if existing is not None:
+            profile.daily_stats = existing.daily_stats
 
         # Save profile before initializing statistics
-        users[user_id] = profile
+        profiles.put(profile)
+        pending_profiles.pop(user_id, None)
+        reminders.schedule(user_id)
 
-        # Initialize current day statistics
+        # Initialize current day statistics, goals are recomputed only if profile inputs changed
         stats = await profile.get_current_stats()
+        profile.refresh_goals(stats, temp)
 
         await state.clear()  # Clear state
         logger.info("Profile set up for user %s", user_id)
-        await message.answer(
+        outbox.answer(
+            message,
             "✅ Profile set up!\n"
             f"💧 Water goal: {stats.water_goal:.0f} ml\n"
             f"🔥 Calorie goal: {stats.calorie_goal:.0f} kcal\n\n"
@@ -204,28 +336,30 @@ async def process_city(message: Message, state: FSMContext):
             "/log_workout <type> <minutes> - log workout 🏃‍♂️\n"
             "/check_progress - check progress 🏁\n"
             "/charts - show progress charts 📊\n"
-            "/history - show activity history 📅"
+            "/history - show activity history 📅\n"
+            "/export [csv|jsonl|parquet] - export your data 📦"
         )
     except Exception as e:
         logger.error("Error setting up profile: %s", e)
-        await message.answer(
+        outbox.answer(
+            message,
             "❌ Failed to get weather data.\n"
             "Please check the city name and try again.\n"
             "For example: Moscow, London, New York"
         )
 
 
-@router.message(Command("log_water"))
+@router.message(RouteCommand(CommandName.LOG_WATER))
 async def cmd_log_water(message: Message, command: CommandObject, state: FSMContext):
     """Logs the user water intake"""
     logger.debug("command.args: %s", command.args)
     if not command.args:
         await state.set_state(WaterLogging.waiting_for_water)
-        await message.answer("Please enter the amount of water consumed in ml:")
+        outbox.answer(message, "Please enter the amount of water consumed in ml:")
         return
 
-    user_id = message.from_user.id
-    stats = await users[user_id].get_current_stats()
+    profile = await profiles.get(message.from_user.id)
+    stats = await profile.get_current_stats()
 
     water_text = command.args
     logger.debug("water_text: %s", water_text)
@@ -233,12 +367,13 @@ async def cmd_log_water(message: Message, command: CommandObject, state: FSMCont
         water_amount = float(water_text)
         stats.logged_water += water_amount
         remaining = stats.water_goal - stats.logged_water
-        await message.answer(
+        outbox.answer(
+            message,
             f"✅ Logged: {water_amount} ml of water\n"
             f"💧 Remaining to drink: {max(0, remaining)} ml"
         )
     except ValueError:
-        await message.answer("Please enter a valid number.")
+        outbox.answer(message, "Please enter a valid number.")
 
 
 @router.message(WaterLogging.waiting_for_water)
@@ -249,51 +384,77 @@ async def process_water_logging(message: Message, state: FSMContext):
     await cmd_log_water(message, CommandObject(prefix="/", command="log_water", args=message.text), state)
 
 
-@router.message(Command("log_food"))
+def food_keyboard(names: list[str]) -> ReplyKeyboardMarkup | None:
+    """Creates a reply keyboard with food suggestions"""
+    if not names:
+        return None
+    return ReplyKeyboardMarkup(
+        keyboard=[[KeyboardButton(text=name)] for name in names],
+        resize_keyboard=True,
+        one_time_keyboard=True
+    )
+
+
+@router.message(RouteCommand(CommandName.LOG_FOOD))
 async def cmd_log_food(message: Message, command: CommandObject, state: FSMContext):
     """Logs the user food intake"""
     logger.debug("command.args: %s", command.args)
+    profile = await profiles.get(message.from_user.id)
     if not command.args:
         await state.set_state(FoodLogging.waiting_for_food_name)
-        await message.answer(
-            "Please enter the food name (in English)."
+        outbox.answer(
+            message,
+            "Please enter the food name (in English).",
+            reply_markup=food_keyboard(food_suggestions.suggest(profile))
         )
         return
 
-    # OpenFoodFacts API call
-    # food_info = await get_food_info(command.args)
-
-    # FatSecret API call
-    food_info = await get_food_info_from_fs(command.args)
-
-    if not food_info:
-        logger.error("Food not found: %s", command.args)
-        await message.answer(
-            "Sorry, couldn't find information about this food.\n"
-            "Try another food or check the spelling."
-        )
-        return
-    if food_info.get("error"):
-        error_message = f"Error getting food information: {food_info['name']}\n"
+    # Foods logged before are taken from history without API calls
+    known_food = food_suggestions.lookup(profile, command.args)
+    if known_food is not None:
+        food_info = {"name": known_food.name, "calories": known_food.calories_per_100}
+    else:
+        # OpenFoodFacts API call
+        # food_info = await get_food_info(command.args)
+
+        # FatSecret API call
+        food_info = await get_food_info_from_fs(command.args)
+
+    if not food_info or food_info.get("error"):
+        if not food_info:
+            logger.error("Food not found: %s", command.args)
+            error_message = "Sorry, couldn't find information about this food.\n"
+        else:
+            error_message = f"Error getting food information: {food_info['name']}\n"
         error_message += "Try another food or check the spelling."
-        if food_info.get("suggest"):
+        if food_info and food_info.get("suggest"):
             error_message += f"\n**Note**: {food_info['suggest']}"
-        await message.answer(error_message)
+
+        # Offer similar foods from history
+        suggestions = food_suggestions.suggest(profile, command.args)
+        if suggestions:
+            await state.set_state(FoodLogging.waiting_for_food_name)
+            error_message += "\nOr pick one of the foods you logged before:"
+        outbox.answer(message, error_message, reply_markup=food_keyboard(suggestions))
         return
     try:
         await state.update_data(
             food_name=food_info["name"],
+            food_query=command.args,
             calories_per_100=float(food_info["calories"])
         )
         await state.set_state(FoodLogging.waiting_for_weight)
-        await message.answer(
+        outbox.answer(
+            message,
             f"🍎 {food_info['name']}\n"
             f"Calories: {food_info['calories']:.1f} kcal/100g\n"
-            "How many grams did you eat?"
+            "How many grams did you eat?",
+            reply_markup=ReplyKeyboardRemove()
         )
     except Exception as e:
         logger.error("Error processing food information: %s", e)
-        await message.answer(
+        outbox.answer(
+            message,
             "An error occurred while processing food information.\n"
             "Please try another food."
         )
@@ -314,30 +475,36 @@ async def process_food_weight(message: Message, state: FSMContext):
         food_data = await state.get_data()
         calories = food_data['calories_per_100'] * weight / 100
 
-        user_id = message.from_user.id
-        stats = await users[user_id].get_current_stats()
+        profile = await profiles.get(message.from_user.id)
+        stats = await profile.get_current_stats()
+        food_suggestions.record(
+            profile, food_data['food_name'], food_data['calories_per_100'], query=food_data.get('food_query')
+        )
         stats.logged_calories += calories
         stats.food_log.append({
             "name": food_data['food_name'],
             "weight": weight,
             "calories": calories,
-            "timestamp": datetime.now().isoformat()
+            "calories_per_100": food_data['calories_per_100'],
+            "timestamp": profile.now().isoformat()
         })
 
         await state.clear()
-        await message.answer(
+        outbox.answer(
+            message,
             f"✅ Logged: {food_data['food_name']}\n"
             f"- Weight: {weight} g\n"
             f"- Calories: {calories:.1f} kcal"
         )
     except ValueError:
-        await message.answer("Please enter the weight in grams as a number.")
+        outbox.answer(message, "Please enter the weight in grams as a number.")
 
 
 async def validate_workout_type(message: Message, workout_type: str | None) -> bool:
     """Checks the validity of the workout type and sends a message if the type is invalid"""
     if not workout_type or workout_type not in WORKOUT_CALORIES:
-        await message.answer(
+        outbox.answer(
+            message,
             "Unknown workout type.\n"
             "Available types: " + ", ".join(WORKOUT_CALORIES.keys())
         )
@@ -354,7 +521,7 @@ async def process_workout_type(message: Message, state: FSMContext):
 
     await state.update_data(workout_type=message.text)
     await state.set_state(WorkoutLogging.waiting_for_workout_duration)
-    await message.answer("How many minutes did you workout?")
+    outbox.answer(message, "How many minutes did you workout?")
 
 
 @router.message(WorkoutLogging.waiting_for_workout_duration)
@@ -364,7 +531,7 @@ async def process_workout_duration(message: Message, state: FSMContext):
     try:
         workout_duration = int(message.text)
     except ValueError:
-        await message.answer("Please enter the workout duration as a number in minutes.")
+        outbox.answer(message, "Please enter the workout duration as a number in minutes.")
         return
 
     await state.update_data(workout_duration=workout_duration)
@@ -372,7 +539,7 @@ async def process_workout_duration(message: Message, state: FSMContext):
     await cmd_log_workout(message, CommandObject(prefix="/", command="log_workout"), state)
 
 
-@router.message(Command("log_workout"))
+@router.message(RouteCommand(CommandName.LOG_WORKOUT))
 async def cmd_log_workout(message: Message, command: CommandObject, state: FSMContext):
     """Logs the user workout"""
     logger.debug("command.args: %s", command.args)
@@ -387,22 +554,23 @@ async def cmd_log_workout(message: Message, command: CommandObject, state: FSMCo
                 if await validate_workout_type(message, command.args):
                     await state.update_data(workout_type=command.args)
                     await state.set_state(WorkoutLogging.waiting_for_workout_duration)
-                    await message.answer("How many minutes did you workout?")
+                    outbox.answer(message, "How many minutes did you workout?")
             else:
                 await state.set_state(WorkoutLogging.waiting_for_workout_type)
-                await message.answer(
+                outbox.answer(
+                    message,
                     "Please specify the workout type.\n"
                     "Available types: " + ", ".join(WORKOUT_CALORIES.keys())
                 )
             return
         if state_data.get('workout_duration', None) is None:
             await state.set_state(WorkoutLogging.waiting_for_workout_duration)
-            await message.answer("How many minutes did you workout?")
+            outbox.answer(message, "How many minutes did you workout?")
             return
         return
 
-    user_id = message.from_user.id
-    stats = await users[user_id].get_current_stats()
+    profile = await profiles.get(message.from_user.id)
+    stats = await profile.get_current_stats()
     workout_type = state_data['workout_type']
     workout_duration = state_data['workout_duration']
 
@@ -415,41 +583,46 @@ async def cmd_log_workout(message: Message, command: CommandObject, state: FSMCo
             "type": workout_type,
             "duration": workout_duration,
             "calories": calories_burned,
-            "timestamp": datetime.now().isoformat()
+            "timestamp": profile.now().isoformat()
         })
         await state.clear()
-        await message.answer(
+        outbox.answer(
+            message,
             f"🏃‍♂️ {workout_type.capitalize()} {workout_duration} minutes\n"
             f"- Calories burned: {calories_burned} kcal\n"
             f"💧 Recommended water intake: {water_needed} ml of water"
         )
     except ValueError:
-        await message.answer("Please enter the workout duration in minutes as a number.")
+        outbox.answer(message, "Please enter the workout duration in minutes as a number.")
     except Exception as e:
-        await message.answer("An error occurred while logging the workout: %s", e)
+        logger.error("Error logging workout: %s", e)
+        outbox.answer(message, "An error occurred while logging the workout.")
 
 
-@router.message(Command("check_progress"))
+@router.message(RouteCommand(CommandName.CHECK_PROGRESS))
 async def cmd_check_progress(message: Message):
     """Checks the user progress"""
-    user_id = message.from_user.id
-    user = users[user_id]
+    user = await profiles.get(message.from_user.id)
     stats = await user.get_current_stats()
 
-    # Update goals for the current day
-    temp = await get_temperature(user.city, WEATHER_API_KEY)
-    if temp is not None:
-        await user.update_daily_goals(temp)
-
-        # If the temperature changed significantly, give a recommendation
-        if abs(temp - stats.temperature) > 5:
-            temp_diff = "increased" if temp > stats.temperature else "decreased"
-            await message.answer(
+    # Update goals for the current day, recomputed only if the temperature bucket changed
+    weather = await get_weather(user.city, WEATHER_API_KEY)
+    if weather is not None:
+        temp = user.apply_weather(weather)
+        previous_temp = stats.temperature
+        previous_water_goal = stats.water_goal
+
+        # If the water goal changed with the temperature, give a recommendation
+        if user.refresh_goals(stats, temp) and stats.water_goal != previous_water_goal:
+            temp_diff = "increased" if temp > previous_temp else "decreased"
+            outbox.answer(
+                message,
                 f"🌡 Temperature {temp_diff}!\n"
                 f"New recommendation for water intake: {stats.water_goal} ml"
             )
 
-    await message.answer(
+    outbox.answer(
+        message,
         "📊 Progress for today:\n"
         f"Water:\n"
         f"- Drunk: {stats.logged_water} ml out of {stats.water_goal} ml.\n"
@@ -462,11 +635,11 @@ async def cmd_check_progress(message: Message):
     )
 
 
-@router.message(Command("charts"))
+@router.message(RouteCommand(CommandName.CHARTS))
 async def cmd_charts(message: Message):
     """Sends progress charts to the user"""
-    user_id = message.from_user.id
-    stats = await users[user_id].get_current_stats()
+    profile = await profiles.get(message.from_user.id)
+    stats = await profile.get_current_stats()
 
     try:
         # Generate chart
@@ -479,7 +652,8 @@ async def cmd_charts(message: Message):
         )
 
         # Send chart with caption
-        await message.answer_photo(
+        outbox.answer_photo(
+            message,
             photo,
             caption=(
                 "📊 Your progress for today:\n"
@@ -492,14 +666,15 @@ async def cmd_charts(message: Message):
         )
     except Exception as e:
         print(f"Error generating charts: {e}")
-        await message.answer("Sorry, an error occurred while generating charts.")
+        outbox.answer(message, "Sorry, an error occurred while generating charts.")
 
 
-@router.message(Command("history"))
+@router.message(RouteCommand(CommandName.HISTORY))
 async def cmd_history(message: Message, state: FSMContext):
     """Shows the activity history of the user"""
     await state.set_state(HistoryPeriod.waiting_for_period)
-    await message.answer(
+    outbox.answer(
+        message,
         "For which period would you like to see the history?\n"
         "1 - Today\n"
         "7 - This week\n"
@@ -516,67 +691,181 @@ async def process_history_period(message: Message, state: FSMContext):
         if not 1 <= days <= 30:
             raise ValueError("Period must be between 1 and 30 days")
 
-        user_id = message.from_user.id
-        user = users[user_id]
-
-        # Get history for the specified period
-        # start_date = datetime.now().date() - timedelta(days=days)
+        user = await profiles.get(message.from_user.id)
 
         # Format report
         report = f"📊 Activity history for the last {days} days:\n\n"
 
-        # Iterate through all days in the range
-        for day_offset in range(days-1, -1, -1):
-            date = (datetime.now().date() - timedelta(days=day_offset)).isoformat()
-            if date in user.daily_stats:
-                stats = user.daily_stats[date]
-                day_str = datetime.fromisoformat(date).strftime("%d.%m")
-
-                report += f"📅 {day_str}:\n"
-                report += f"💧 Water: {stats.logged_water}/{stats.water_goal} ml\n"
-                report += f"🔥 Calories: {stats.logged_calories}/{stats.calorie_goal} kcal\n"
-                report += f"💪 Burned: {stats.burned_calories} kcal\n"
-
-                if stats.food_log:
-                    report += "🍽 Food:\n"
-                    for log in stats.food_log:
-                        time = datetime.fromisoformat(log['timestamp']).strftime("%H:%M")
-                        report += f"- {time}: {log['name']} ({log['weight']}g, {log['calories']:.1f} kcal)\n"
-
-                if stats.workout_log:
-                    report += "🏃‍♂️ Workouts:\n"
-                    for log in stats.workout_log:
-                        time = datetime.fromisoformat(log['timestamp']).strftime("%H:%M")
-                        report += f"- {time}: {log['type'].capitalize()} ({log['duration']} min, {log['calories']} kcal)\n"  # noqa: E501  pylint: disable=line-too-long (C0301)
-
-                report += "\n"
-
-        if not user.daily_stats:
+        # Days of the period in the user's timezone, days without stats are skipped
+        period = user.last_days(days)
+        for stats in period:
+            day_str = day_date(stats.day).strftime("%d.%m")
+
+            report += f"📅 {day_str}:\n"
+            report += f"💧 Water: {stats.logged_water}/{stats.water_goal} ml\n"
+            report += f"🔥 Calories: {stats.logged_calories}/{stats.calorie_goal} kcal\n"
+            report += f"💪 Burned: {stats.burned_calories} kcal\n"
+
+            if stats.food_log:
+                report += "🍽 Food:\n"
+                for log in stats.food_log:
+                    time = datetime.fromisoformat(log['timestamp']).strftime("%H:%M")
+                    report += f"- {time}: {log['name']} ({log['weight']}g, {log['calories']:.1f} kcal)\n"
+
+            if stats.workout_log:
+                report += "🏃‍♂️ Workouts:\n"
+                for log in stats.workout_log:
+                    time = datetime.fromisoformat(log['timestamp']).strftime("%H:%M")
+                    report += f"- {time}: {log['type'].capitalize()} ({log['duration']} min, {log['calories']} kcal)\n"  # noqa: E501  pylint: disable=line-too-long (C0301)
+
+            report += "\n"
+
+        if not period:
             report += "No data for the specified period"
 
         # Send report
-        await message.answer(report)
+        outbox.answer(message, report)
         await state.clear()
 
     except ValueError as e:
-        await message.answer(str(e))
+        outbox.answer(message, str(e))
     except Exception as e:
-        await message.answer("An error occurred while getting the history.")
+        outbox.answer(message, "An error occurred while getting the history.")
         logger.error("Error in history: %s", e)
 
 
+async def send_export(message: Message, records, fmt: str, name: str):
+    """Streams records to export files in a thread and sends them as documents, split into parts if large"""
+    try:
+        paths, count = await asyncio.to_thread(export_records, records, fmt, name)
+    except ImportError as e:
+        logger.error("Export format %s is not available: %s", fmt, e)
+        outbox.answer(message, f"Sorry, {fmt} export is not available right now.")
+        return
+    except Exception as e:
+        logger.error("Error exporting data: %s", e)
+        outbox.answer(message, "An error occurred while exporting the data.")
+        return
+
+    if count == 0:
+        outbox.answer(message, "No data to export yet.")
+        return
+    for part, path in enumerate(paths, 1):
+        caption = f"📦 Exported {count} records" + (f", part {part} of {len(paths)}" if len(paths) > 1 else "")
+        if os.path.getsize(path) > EXPORT_MAX_DOCUMENT_SIZE:
+            logger.warning("Export part %s is too large to send", path)
+            outbox.answer(message, f"{caption}: the file is too large to send.")
+            continue
+        outbox.answer_document(message, FSInputFile(path), caption=caption)
+
+
+def parse_export_format(command: CommandObject) -> str | None:
+    """Returns the export format from command arguments (csv by default) or None if unknown"""
+    fmt = (command.args or "csv").strip().lower()
+    return fmt if fmt in EXPORT_FORMATS else None
+
+
+@router.message(RouteCommand(CommandName.EXPORT))
+async def cmd_export(message: Message, command: CommandObject):
+    """Exports the user data"""
+    fmt = parse_export_format(command)
+    if fmt is None:
+        outbox.answer(message, "Usage: /export [" + "|".join(EXPORT_FORMATS) + "]")
+        return
+
+    user_id = message.from_user.id
+    await send_export(message, iter_profile_records(await profiles.get(user_id)), fmt, f"user_{user_id}")
+
+
+@router.message(RouteCommand(CommandName.EXPORT_ALL))
+async def cmd_export_all(message: Message, command: CommandObject):
+    """Exports data of all users (admins only)"""
+    if message.from_user.id not in ADMIN_IDS:
+        outbox.answer(message, "This command is available to administrators only.")
+        return
+    fmt = parse_export_format(command)
+    if fmt is None:
+        outbox.answer(message, "Usage: /export_all [" + "|".join(EXPORT_FORMATS) + "]")
+        return
+
+    # Resident profiles are collected on the event loop, stored ones are read in the export thread
+    await send_export(message, iter_records(profiles.iter_all()), fmt, "all_users")
+
+
+@router.message(RouteCommand(CommandName.ANALYTICS))
+async def cmd_analytics(message: Message):
+    """Shows precomputed cross-user analytics (admins only)"""
+    if message.from_user.id not in ADMIN_IDS:
+        outbox.answer(message, "This command is available to administrators only.")
+        return
+    cache = profiles.stats()
+    load = "\n".join(
+        f"- {name}: {stats['active']} active, {stats['queued']} queued, {stats['shed']} shed"
+        for name, stats in admission.stats().items()
+    )
+    outbox.answer(
+        message,
+        f"{analytics.report()}\n\n"
+        f"🗄 Profile cache: {cache['resident']} of {cache['known']} users in memory "
+        f"({cache['resident_days']} days), hit rate {cache['hit_rate']:.0%}, "
+        f"{cache['evictions']} evictions\n\n"
+        f"🚦 Request load:\n{load}"
+    )
+
+
 # Start bot
 async def main():
     """Starts the bot"""
+    reminder_task = analytics_task = store_task = cache_task = simulation_task = None
+    # Offline mode: the bot talks to the stub server, virtual users generate the load
+    simulation = None
+    if SIMULATION:
+        from simulation import Simulation  # pylint: disable=import-outside-toplevel (C0415)
+        simulation = Simulation()
     try:
-        bot = Bot(token=BOT_TOKEN)
-        dp = Dispatcher()
+        # Restore state saved by the previous container and compact it into a new snapshot
+        await profiles.open()
+        store.restore()
+        recompute_goals(profiles.resident())
+        for key, record in store.fsm_storage.storage.items():
+            if state_group(record.state) == ProfileSetup.__name__ and key.user_id not in profiles:
+                add_pending_profile(key.user_id)
+        await store.snapshot()
+
+        if simulation is not None:
+            await simulation.start()
+            bot = Bot(token=BOT_TOKEN, session=simulation.session())
+        else:
+            bot = Bot(token=BOT_TOKEN)
+        dp = Dispatcher(storage=store.fsm_storage)
         dp.include_router(router)
+        setup_middleware(dp)
+        outbox.start(bot)
+        reminders.load()
+        await asyncio.to_thread(food_suggestions.rebuild, profiles.iter_all())
+        store_task = asyncio.create_task(store.run())
+        cache_task = asyncio.create_task(profiles.run())
+        reminder_task = asyncio.create_task(reminders.run())
+        analytics_task = asyncio.create_task(analytics.run())
+        if simulation is not None:
+            simulation_task = asyncio.create_task(simulation.run(on_finished=dp.stop_polling))
 
         logger.info("Bot started!")
         await dp.start_polling(bot)
     except Exception as e:
         logger.error("Error starting bot: %s", e)
+    finally:
+        background_tasks = [
+            task for task in (store_task, cache_task, reminder_task, analytics_task, simulation_task) if task
+        ]
+        for task in background_tasks:
+            task.cancel()
+        await asyncio.gather(*background_tasks, return_exceptions=True)
+        await outbox.stop()
+        if simulation is not None:
+            await simulation.stop()
+        await store.close()
+        await profiles.close()
 
 if __name__ == "__main__":
     asyncio.run(main())
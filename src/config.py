@@ -10,6 +10,15 @@ BOT_TOKEN = os.getenv("BOT_TOKEN")
 WEATHER_API_KEY = os.getenv("WEATHER_API_KEY")
 LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
 
+# Offline simulation with stub Telegram, weather and FatSecret services (see simulation.py)
+SIMULATION = os.getenv("SIMULATION", "").lower() in ("1", "true", "yes")
+
+# Directory for persistent bot data, simulated users are kept apart from real ones
+DATA_DIR = os.getenv("DATA_DIR", os.path.join("data", "simulation") if SIMULATION else "data")
+
+# Telegram IDs of bot administrators, comma separated
+ADMIN_IDS = {int(admin_id) for admin_id in os.getenv("ADMIN_IDS", "").split(",") if admin_id.strip()}
+
 # FatSecret
 CONSUMER_KEY = os.getenv("CONSUMER_KEY")
 CONSUMER_SECRET = os.getenv("CONSUMER_SECRET")
@@ -26,16 +35,57 @@ console_handler = logging.StreamHandler()
 console_handler.setFormatter(formatter)
 logger.addHandler(console_handler)
 
-# Check for required environment variables
-if not all([BOT_TOKEN, WEATHER_API_KEY, CONSUMER_KEY, CONSUMER_SECRET]):
+# Check for required environment variables, stub services don't need credentials
+if SIMULATION:
+    BOT_TOKEN = "123456:SIMULATION"
+elif not all([BOT_TOKEN, WEATHER_API_KEY, CONSUMER_KEY, CONSUMER_SECRET]):
     logger.error("Missing required environment variables")
     raise ValueError("Missing required environment variables")
 
+# Simulation: stub server, virtual users and fault injection
+SIM_HOST = os.getenv("SIM_HOST", "127.0.0.1")
+SIM_PORT = int(os.getenv("SIM_PORT", "8081"))
+# Same seed - same users, messages and faults of the n-th call per chat, city or food query (rate limits depend on timing)
+SIM_SEED = int(os.getenv("SIM_SEED", "42"))
+SIM_USERS = int(os.getenv("SIM_USERS", "50"))  # virtual users chatting with the bot concurrently
+SIM_ACTIONS = int(os.getenv("SIM_ACTIONS", "20"))  # actions of each user after profile setup
+SIM_THINK_TIME = float(os.getenv("SIM_THINK_TIME", "1"))  # mean seconds between messages of a user
+SIM_REPLY_TIMEOUT = float(os.getenv("SIM_REPLY_TIMEOUT", "30"))  # user gives up waiting for a reply
+# Stub services: (mean latency in seconds, error rate 0..1, rate limit in requests per second, 0 - unlimited)
+SIM_SERVICES = {
+    "telegram": (
+        float(os.getenv("SIM_TELEGRAM_LATENCY", "0.05")),
+        float(os.getenv("SIM_TELEGRAM_ERROR_RATE", "0")),
+        float(os.getenv("SIM_TELEGRAM_RATE_LIMIT", "30")),
+    ),
+    "weather": (
+        float(os.getenv("SIM_WEATHER_LATENCY", "0.2")),
+        float(os.getenv("SIM_WEATHER_ERROR_RATE", "0")),
+        float(os.getenv("SIM_WEATHER_RATE_LIMIT", "0")),
+    ),
+    "fatsecret": (
+        float(os.getenv("SIM_FATSECRET_LATENCY", "0.3")),
+        float(os.getenv("SIM_FATSECRET_ERROR_RATE", "0")),
+        float(os.getenv("SIM_FATSECRET_RATE_LIMIT", "0")),
+    ),
+}
+
+# Weather API, served by the stub server in simulation
+WEATHER_API_URL = os.getenv(
+    "WEATHER_API_URL",
+    f"http://{SIM_HOST}:{SIM_PORT}/data/2.5/weather" if SIMULATION else "http://api.openweathermap.org/data/2.5/weather"
+)
+
 # Constants for calculations
 WATER_PER_KG = 30  # ml of water per kg of weight
 WATER_PER_ACTIVITY = 500  # ml of water per 30 minutes of base activity
 WATER_PER_WORKOUT = 200  # ml of water per 30 minutes of workout
 WATER_HOT_WEATHER = 500  # additional water in hot weather
+WATER_HOT_THRESHOLD = 25  # temperature above which the weather is considered hot
+DEFAULT_TEMPERATURE = 20  # used when the weather service is unavailable
+
+# Changes whenever a goal calculation constant changes, so that stored goals get recomputed
+GOALS_VERSION = hash((WATER_PER_KG, WATER_PER_ACTIVITY, WATER_HOT_WEATHER, WATER_HOT_THRESHOLD))
 
 # Calories burned per minute for different activities
 WORKOUT_CALORIES = {
@@ -46,3 +96,71 @@ WORKOUT_CALORIES = {
     "yoga": 3,
     "power": 6
 }
+
+# Outbound message delivery (Telegram flood limits)
+SEND_GLOBAL_RATE = 25  # messages per second across all chats
+SEND_CHAT_RATE = 1  # messages per second to a single chat
+SEND_CHAT_BURST = 3  # messages a single chat may receive back-to-back
+SEND_MAX_RETRIES = 3  # retries for network and Telegram server errors before a message is dropped
+SEND_PRUNE_INTERVAL = 60  # seconds between sweeps that forget rate limit state of idle chats
+TELEGRAM_MAX_MESSAGE_LENGTH = 4096  # coalesced messages never exceed this
+
+# Water reminders
+REMINDER_INTERVAL = 2 * 60 * 60  # seconds between checks of a single user
+REMINDER_START_HOUR = 9  # no reminders before this hour
+REMINDER_END_HOUR = 21  # no reminders after this hour, water goal should be reached by then
+REMINDER_INACTIVE_DAYS = 7  # users who logged nothing for longer are not reminded until they come back
+REMINDER_BATCH_SIZE = 500  # users processed before yielding to the event loop
+REMINDER_SAVE_INTERVAL = 60  # seconds between saves of pending reminders
+REMINDERS_FILE = os.path.join(DATA_DIR, "reminders.json")
+
+# Data export
+EXPORT_DIR = os.path.join(DATA_DIR, "exports")
+EXPORT_TTL = 60 * 60  # seconds export files are kept on disk
+EXPORT_BATCH_SIZE = 10000  # records per Parquet row group
+EXPORT_MAX_DOCUMENT_SIZE = 50 * 1024 * 1024  # Telegram limit for documents sent by bots
+EXPORT_PART_SIZE = 45 * 1024 * 1024  # exports are split into parts of about this size, below the document limit
+
+# Cross-user analytics
+ANALYTICS_INTERVAL = 10 * 60  # seconds between refreshes of the aggregates
+ANALYTICS_WINDOW_DAYS = 7  # days included in the analytics report
+ANALYTICS_TOP_FOODS = 5  # number of most popular foods in the report
+
+# Food name suggestions
+FOOD_SUGGESTIONS = 5  # suggestions shown on the reply keyboard
+FOOD_INDEX_MAX_SIZE = 100000  # foods (and search aliases) kept in the global index
+FOOD_USER_INDEX_MAX_SIZE = 1000  # foods (and search aliases) kept in a user index
+FOOD_USER_INDEXES = 10000  # user indexes kept in memory, others are rebuilt from history when needed
+
+# State snapshots and change journal
+SNAPSHOT_FILE = os.path.join(DATA_DIR, "state.snapshot")
+SNAPSHOT_INTERVAL = 5 * 60  # seconds between full snapshots
+JOURNAL_FLUSH_INTERVAL = 1  # seconds between journal writes
+
+# Admission control
+# Command -> (cost class, priority within the class: lower is served first), other commands are "cheap"
+COMMAND_COSTS = {
+    "log_food": ("expensive", 0),
+    "export": ("expensive", 2),
+    "export_all": ("expensive", 3),
+    "charts": ("render", 0),
+}
+# FSM state -> (cost class, priority) for replies that continue an expensive command
+STATE_COSTS = {
+    "FoodLogging:waiting_for_food_name": ("expensive", 0),
+    "HistoryPeriod:waiting_for_period": ("expensive", 1),
+}
+# Cost class -> (concurrent requests, queued requests, seconds a request may wait in the queue)
+ADMISSION_LIMITS = {
+    "cheap": (64, 1000, 30),
+    "expensive": (8, 32, 10),
+    "render": (2, 8, 10),
+}
+ADMISSION_USER_LIMIT = 1  # requests of a single user in progress or queued in an expensive class
+PROFILE_SETUP_TTL = 60 * 60  # seconds an unfinished /set_profile lets a user without profile through
+
+# Profile cache
+PROFILES_DB = os.path.join(DATA_DIR, "profiles.db")  # profiles evicted from memory
+PROFILE_CACHE_SIZE = 10000  # profiles kept in memory
+PROFILE_CACHE_TTL = 24 * 60 * 60  # seconds an inactive profile is kept in memory
+PROFILE_CACHE_SWEEP_INTERVAL = 60  # seconds between evictions of inactive profiles
@@ -0,0 +1,105 @@
+import bisect
+import time
+from datetime import date, datetime, timedelta, timezone
+from typing import Dict, Generic, Iterator, List, Optional, Tuple, TypeVar
+
+# Day numbers are proleptic Gregorian ordinals (date.toordinal()), so they convert to dates without parsing
+EPOCH_DAY = date(1970, 1, 1).toordinal()
+SECONDS_PER_DAY = 86400
+
+# Range of UTC offsets in use, a calendar day lasts from UTC+14 to UTC-12
+MIN_UTC_OFFSET = -12 * 3600
+MAX_UTC_OFFSET = 14 * 3600
+
+T = TypeVar("T")
+
+
+def current_day(utc_offset: int = 0, now: Optional[float] = None) -> int:
+    """Returns the current day number in the timezone with the given offset from UTC in seconds"""
+    if now is None:
+        now = time.time()
+    return EPOCH_DAY + (int(now) + utc_offset) // SECONDS_PER_DAY
+
+
+def day_number(day: date) -> int:
+    """Converts date to day number"""
+    return day.toordinal()
+
+
+def day_date(day: int) -> date:
+    """Converts day number to date"""
+    return date.fromordinal(day)
+
+
+def day_iso(day: int) -> str:
+    """Converts day number to ISO format date string"""
+    return date.fromordinal(day).isoformat()
+
+
+def user_timezone(utc_offset: int) -> timezone:
+    """Returns the fixed-offset timezone of a user"""
+    return timezone(timedelta(seconds=utc_offset))
+
+
+def local_now(utc_offset: int) -> datetime:
+    """Returns the current time in the user's timezone"""
+    return datetime.now(user_timezone(utc_offset))
+
+
+class DayIndex(Generic[T]):
+    """
+    Daily values keyed by day number.
+    Day numbers are kept in a sorted array next to the dict, so range queries are a binary
+    search followed by a slice. New days are almost always the latest ones and are appended.
+    """
+    def __init__(self):
+        self._days: List[int] = []  # sorted day numbers
+        self._values: Dict[int, T] = {}
+
+    def __len__(self) -> int:
+        return len(self._days)
+
+    def __contains__(self, day: int) -> bool:
+        return day in self._values
+
+    def __getitem__(self, day: int) -> T:
+        return self._values[day]
+
+    def __setitem__(self, day: int, value: T):
+        # The value is set before the day becomes visible to range queries, which may run in other threads
+        is_new = day not in self._values
+        self._values[day] = value
+        if is_new:
+            if not self._days or day > self._days[-1]:
+                self._days.append(day)
+            else:
+                bisect.insort(self._days, day)
+
+    def __iter__(self) -> Iterator[int]:
+        return iter(self._days)
+
+    def latest(self) -> Optional[int]:
+        """Returns the latest day number or None if there are no days"""
+        return self._days[-1] if self._days else None
+
+    def get(self, day: int, default: Optional[T] = None) -> Optional[T]:
+        """Returns value of the day or default"""
+        return self._values.get(day, default)
+
+    def values(self) -> List[T]:
+        """Returns values in day order"""
+        return [self._values[day] for day in self._days]
+
+    def items(self) -> List[Tuple[int, T]]:
+        """Returns (day number, value) pairs in day order"""
+        return [(day, self._values[day]) for day in self._days]
+
+    def range(self, start: int, end: int) -> List[T]:
+        """Returns values of days in [start, end) in day order"""
+        lo = bisect.bisect_left(self._days, start)
+        hi = bisect.bisect_left(self._days, end, lo)
+        return [self._values[day] for day in self._days[lo:hi]]
+
+    def last(self, days: int, until: int) -> List[T]:
+        """Returns values of the last `days` days ending with `until` (inclusive)"""
+        return self.range(until - days + 1, until + 1)
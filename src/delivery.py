@@ -0,0 +1,266 @@
+import asyncio
+import heapq
+import itertools
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Any, Callable, Deque, Dict, List, Optional, Set, Tuple
+from aiogram import Bot
+from aiogram.exceptions import (
+    TelegramAPIError, TelegramBadRequest, TelegramForbiddenError, TelegramNetworkError, TelegramRetryAfter,
+    TelegramServerError
+)
+from aiogram.types import Message
+from config import (
+    logger, SEND_GLOBAL_RATE, SEND_CHAT_RATE, SEND_CHAT_BURST, SEND_MAX_RETRIES, SEND_PRUNE_INTERVAL,
+    TELEGRAM_MAX_MESSAGE_LENGTH
+)
+
+
+class TokenBucket:
+    """Token bucket rate limiter"""
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, now: float) -> float:
+        """Returns seconds until a token is available (0 if available now)"""
+        self._refill(now)
+        if self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def consume(self, now: float):
+        """Takes one token from the bucket"""
+        self._refill(now)
+        self.tokens -= 1
+
+    def is_full(self, now: float) -> bool:
+        """Checks whether the bucket has fully refilled"""
+        self._refill(now)
+        return self.tokens >= self.capacity
+
+
+@dataclass
+class OutgoingMessage:
+    """Bot API call waiting for delivery"""
+    method: str  # Bot method name, e.g. "send_message"
+    kwargs: Dict[str, Any]
+    attempts: int = 0
+
+    def can_merge(self, other: "OutgoingMessage") -> bool:
+        """Checks if another text message can be appended to this one"""
+        if self.method != "send_message" or other.method != "send_message":
+            return False
+        # Keyboard of an earlier message would be lost after merging
+        if self.kwargs.get("reply_markup") is not None:
+            return False
+        if self.kwargs.get("parse_mode") != other.kwargs.get("parse_mode"):
+            return False
+        length = len(self.kwargs["text"]) + len(other.kwargs["text"]) + 2
+        return length <= TELEGRAM_MAX_MESSAGE_LENGTH
+
+    def merge(self, other: "OutgoingMessage"):
+        """Appends text (and keyboard) of another message to this one"""
+        self.kwargs = {**other.kwargs, "text": self.kwargs["text"] + "\n\n" + other.kwargs["text"]}
+
+
+@dataclass
+class ChatQueue:
+    """Pending messages and rate limit state of a single chat"""
+    bucket: TokenBucket
+    items: Deque[OutgoingMessage] = field(default_factory=deque)
+    scheduled: bool = False  # chat is in the dispatch heap
+    in_flight: bool = False  # a message to this chat is being sent now
+    blocked_until: float = 0  # set from Telegram's retry_after
+
+
+class DeliveryQueue:  # pylint: disable=too-many-instance-attributes (R0902)
+    """
+    Background delivery of outgoing messages.
+    Handlers only enqueue messages, a dispatcher task sends them respecting
+    the global and per-chat rate limits. Consecutive text messages to the same
+    chat are merged into one, messages rejected with 429 are retried after
+    the `retry_after` returned by Telegram.
+    """
+    def __init__(
+            self,
+            global_rate: float = SEND_GLOBAL_RATE,
+            chat_rate: float = SEND_CHAT_RATE,
+            chat_burst: int = SEND_CHAT_BURST,
+            max_retries: int = SEND_MAX_RETRIES
+    ):
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self._global = TokenBucket(global_rate, global_rate)
+        self._chats: Dict[int, ChatQueue] = {}
+        self._heap: List[Tuple[float, int, int]] = []  # (due time, sequence, chat_id)
+        self._seq = itertools.count()
+        self._wakeup = asyncio.Event()
+        self._sending: Set[asyncio.Task] = set()
+        self._task: Optional[asyncio.Task] = None
+        self._bot: Optional[Bot] = None
+        self._pruned_at = time.monotonic()
+        self._unreachable_listeners: List[Callable[[int], None]] = []
+
+    def start(self, bot: Bot):
+        """Starts the dispatcher task"""
+        self._bot = bot
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self, timeout: float = 10):
+        """Waits for pending messages to be delivered and stops the dispatcher"""
+        deadline = time.monotonic() + timeout
+        while (self._heap or self._sending) and time.monotonic() < deadline:
+            await asyncio.sleep(0.1)
+        if self.pending:
+            logger.warning("Delivery queue stopped with %s undelivered messages", self.pending)
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, *self._sending, return_exceptions=True)
+            self._task = None
+
+    def on_unreachable(self, listener: Callable[[int], None]):
+        """Registers a callback for chats that blocked the bot or no longer exist"""
+        self._unreachable_listeners.append(listener)
+
+    @property
+    def pending(self) -> int:
+        """Number of messages waiting for delivery"""
+        return sum(len(chat.items) for chat in self._chats.values())
+
+    def send_message(self, chat_id: int, text: str, **kwargs):
+        """Enqueues a text message"""
+        self._enqueue(chat_id, OutgoingMessage("send_message", {"text": text, **kwargs}))
+
+    def send_photo(self, chat_id: int, photo, **kwargs):
+        """Enqueues a photo"""
+        self._enqueue(chat_id, OutgoingMessage("send_photo", {"photo": photo, **kwargs}))
+
+    def send_document(self, chat_id: int, document, **kwargs):
+        """Enqueues a document"""
+        self._enqueue(chat_id, OutgoingMessage("send_document", {"document": document, **kwargs}))
+
+    def answer(self, message: Message, text: str, **kwargs):
+        """Enqueues a text reply to the chat of the message"""
+        self.send_message(message.chat.id, text, **kwargs)
+
+    def answer_photo(self, message: Message, photo, **kwargs):
+        """Enqueues a photo reply to the chat of the message"""
+        self.send_photo(message.chat.id, photo, **kwargs)
+
+    def answer_document(self, message: Message, document, **kwargs):
+        """Enqueues a document reply to the chat of the message"""
+        self.send_document(message.chat.id, document, **kwargs)
+
+    def _enqueue(self, chat_id: int, item: OutgoingMessage):
+        chat = self._chats.get(chat_id)
+        if chat is None:
+            chat = self._chats[chat_id] = ChatQueue(TokenBucket(self.chat_rate, self.chat_burst))
+        chat.items.append(item)
+        if not chat.scheduled and not chat.in_flight:
+            self._schedule(chat_id, chat, time.monotonic())
+
+    def _schedule(self, chat_id: int, chat: ChatQueue, due: float):
+        heapq.heappush(self._heap, (due, next(self._seq), chat_id))
+        chat.scheduled = True
+        self._wakeup.set()
+
+    async def _sleep(self, seconds: Optional[float]):
+        """Sleeps until timeout or until a new chat is scheduled"""
+        self._wakeup.clear()
+        try:
+            await asyncio.wait_for(self._wakeup.wait(), seconds)
+        except asyncio.TimeoutError:
+            pass
+
+    async def _run(self):
+        while True:
+            now = time.monotonic()
+            # Under sustained traffic the heap is never empty, so idle chats are also swept periodically
+            if not self._heap or now - self._pruned_at >= SEND_PRUNE_INTERVAL:
+                self._prune(now)
+            if not self._heap:
+                await self._sleep(None)
+                continue
+
+            due, _, chat_id = self._heap[0]
+            if due > now:
+                await self._sleep(due - now)
+                continue
+
+            chat = self._chats[chat_id]
+            wait = max(chat.bucket.delay(now), chat.blocked_until - now)
+            if wait > 0:
+                # Chat is rate limited, let other chats go first
+                heapq.heapreplace(self._heap, (now + wait, next(self._seq), chat_id))
+                continue
+            wait = self._global.delay(now)
+            if wait > 0:
+                await asyncio.sleep(wait)
+                continue
+
+            heapq.heappop(self._heap)
+            chat.scheduled = False
+            chat.in_flight = True
+            self._global.consume(now)
+            chat.bucket.consume(now)
+            task = asyncio.create_task(self._deliver(chat_id, chat, self._take(chat)))
+            self._sending.add(task)
+            task.add_done_callback(self._sending.discard)
+
+    @staticmethod
+    def _take(chat: ChatQueue) -> OutgoingMessage:
+        """Pops the next message, merging following text messages into it"""
+        item = chat.items.popleft()
+        while chat.items and item.can_merge(chat.items[0]):
+            item.merge(chat.items.popleft())
+        return item
+
+    async def _deliver(self, chat_id: int, chat: ChatQueue, item: OutgoingMessage):
+        try:
+            await getattr(self._bot, item.method)(chat_id=chat_id, **item.kwargs)
+        except TelegramRetryAfter as e:
+            logger.warning("Flood limit for chat %s, retry after %s s", chat_id, e.retry_after)
+            chat.blocked_until = time.monotonic() + e.retry_after
+            chat.items.appendleft(item)
+        except (TelegramNetworkError, TelegramServerError) as e:
+            # Transient failures are retried, other API errors (4xx) are permanent
+            item.attempts += 1
+            if item.attempts > self.max_retries:
+                logger.error("Dropping message to chat %s after %s attempts: %s", chat_id, item.attempts, e)
+            else:
+                chat.blocked_until = time.monotonic() + 2 ** item.attempts  # exponential backoff
+                chat.items.appendleft(item)
+        except TelegramAPIError as e:
+            if isinstance(e, TelegramForbiddenError) or (
+                    isinstance(e, TelegramBadRequest) and "chat not found" in e.message.lower()):
+                logger.info("Chat %s is unreachable: %s", chat_id, e)
+                chat.items.clear()  # nothing else can be delivered there
+                for listener in self._unreachable_listeners:
+                    listener(chat_id)
+            else:
+                logger.error("Error sending message to chat %s: %s", chat_id, e)
+        except Exception as e:
+            logger.error("Unexpected error sending message to chat %s: %s", chat_id, e)
+        finally:
+            chat.in_flight = False
+            if chat.items:
+                self._schedule(chat_id, chat, time.monotonic())
+
+    def _prune(self, now: float):
+        """Forgets idle chats whose rate limit has fully recovered"""
+        self._pruned_at = now
+        idle = [
+            chat_id for chat_id, chat in self._chats.items()
+            if not chat.items and not chat.in_flight and chat.blocked_until <= now and chat.bucket.is_full(now)
+        ]
+        for chat_id in idle:
+            del self._chats[chat_id]
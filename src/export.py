@@ -0,0 +1,180 @@
+import csv
+import gzip
+import json
+import os
+import time
+import uuid
+from itertools import chain, islice
+from typing import Callable, Dict, Iterable, Iterator, List, Tuple
+from config import logger, EXPORT_DIR, EXPORT_TTL, EXPORT_BATCH_SIZE, EXPORT_PART_SIZE
+from models import UserProfile
+
+# Flat schema shared by all record types, fields not applicable to a record are empty
+EXPORT_FIELDS = [
+    "user_id", "date", "record", "timestamp",
+    "name", "type", "weight", "duration", "calories",
+    "logged_water", "water_goal", "logged_calories", "calorie_goal", "burned_calories", "temperature"
+]
+
+
+def iter_profile_records(profile: UserProfile) -> Iterator[Dict]:
+    """Yields daily stats, food and workout records of the user"""
+    for stats in profile.daily_stats.values():
+        date = stats.date
+        yield {
+            "user_id": profile.user_id,
+            "date": date,
+            "record": "day",
+            "logged_water": stats.logged_water,
+            "water_goal": stats.water_goal,
+            "logged_calories": stats.logged_calories,
+            "calorie_goal": stats.calorie_goal,
+            "burned_calories": stats.burned_calories,
+            "temperature": stats.temperature,
+        }
+        for log in stats.food_log:
+            yield {
+                "user_id": profile.user_id,
+                "date": date,
+                "record": "food",
+                "timestamp": log["timestamp"],
+                "name": log["name"],
+                "weight": log["weight"],
+                "calories": log["calories"],
+            }
+        for log in stats.workout_log:
+            yield {
+                "user_id": profile.user_id,
+                "date": date,
+                "record": "workout",
+                "timestamp": log["timestamp"],
+                "type": log["type"],
+                "duration": log["duration"],
+                "calories": log["calories"],
+            }
+
+
+def iter_records(profiles: Iterable[UserProfile]) -> Iterator[Dict]:
+    """Yields records of all given users"""
+    for profile in profiles:
+        yield from iter_profile_records(profile)
+
+
+def _batched(records: Iterable[Dict], size: int) -> Iterator[List[Dict]]:
+    iterator = iter(records)
+    while batch := list(islice(iterator, size)):
+        yield batch
+
+
+# Writers consume records batch by batch and stop once the file reaches max_size bytes,
+# the rest of the records stay in the iterator for the next part
+
+def write_csv(records: Iterator[Dict], path: str, max_size: int) -> int:
+    """Writes records to a gzipped CSV file, returns number of records"""
+    count = 0
+    with gzip.open(path, "wt", newline="", encoding="utf-8") as f:
+        writer = csv.DictWriter(f, EXPORT_FIELDS)
+        writer.writeheader()
+        for batch in _batched(records, EXPORT_BATCH_SIZE):
+            writer.writerows(batch)
+            count += len(batch)
+            if os.path.getsize(path) >= max_size:
+                break
+    return count
+
+
+def write_jsonl(records: Iterator[Dict], path: str, max_size: int) -> int:
+    """Writes records to a gzipped JSON Lines file, returns number of records"""
+    count = 0
+    with gzip.open(path, "wt", encoding="utf-8") as f:
+        for batch in _batched(records, EXPORT_BATCH_SIZE):
+            f.writelines(json.dumps(record, ensure_ascii=False) + "\n" for record in batch)
+            count += len(batch)
+            if os.path.getsize(path) >= max_size:
+                break
+    return count
+
+
+def write_parquet(records: Iterator[Dict], path: str, max_size: int) -> int:
+    """Writes records to a zstd-compressed Parquet file one row group at a time, returns number of records"""
+    import pyarrow as pa  # pylint: disable=import-outside-toplevel (C0415)
+    import pyarrow.parquet as pq  # pylint: disable=import-outside-toplevel (C0415)
+
+    schema = pa.schema([
+        ("user_id", pa.int64()),
+        ("date", pa.string()),
+        ("record", pa.string()),
+        ("timestamp", pa.string()),
+        ("name", pa.string()),
+        ("type", pa.string()),
+        ("weight", pa.float64()),
+        ("duration", pa.int64()),
+        ("calories", pa.float64()),
+        ("logged_water", pa.float64()),
+        ("water_goal", pa.float64()),
+        ("logged_calories", pa.float64()),
+        ("calorie_goal", pa.float64()),
+        ("burned_calories", pa.float64()),
+        ("temperature", pa.float64()),
+    ])
+    count = 0
+    with pq.ParquetWriter(path, schema, compression="zstd") as writer:
+        for batch in _batched(records, EXPORT_BATCH_SIZE):
+            writer.write_table(pa.Table.from_pylist(batch, schema=schema))
+            count += len(batch)
+            if os.path.getsize(path) >= max_size:
+                break
+    return count
+
+
+# Export format -> (writer, file extension)
+EXPORT_FORMATS: Dict[str, Tuple[Callable[[Iterator[Dict], str, int], int], str]] = {
+    "csv": (write_csv, ".csv.gz"),
+    "jsonl": (write_jsonl, ".jsonl.gz"),
+    "parquet": (write_parquet, ".parquet"),
+}
+
+
+def export_records(
+        records: Iterable[Dict],
+        fmt: str,
+        name: str,
+        directory: str = EXPORT_DIR,
+        part_size: int = EXPORT_PART_SIZE
+) -> Tuple[List[str], int]:
+    """
+    Streams records to export files of about `part_size` bytes each. Blocking, should be run in a thread.
+    Returns paths to the parts and number of exported records, no files are left if there were no records
+    """
+    writer, extension = EXPORT_FORMATS[fmt]
+    os.makedirs(directory, exist_ok=True)
+    cleanup_exports(directory)
+    # Random suffix keeps concurrent exports started in the same second apart
+    prefix = os.path.join(directory, f"{name}_{int(time.time())}_{uuid.uuid4().hex[:8]}")
+    records = iter(records)
+    paths: List[str] = []
+    count = 0
+    try:
+        while (first := next(records, None)) is not None:
+            path = f"{prefix}_part{len(paths) + 1}{extension}"
+            paths.append(path)
+            count += writer(chain([first], records), path, part_size)
+    except Exception:
+        for path in paths:
+            if os.path.exists(path):
+                os.remove(path)
+        raise
+    if paths:
+        logger.info("Exported %s records to %s", count, ", ".join(paths))
+    return paths, count
+
+
+def cleanup_exports(directory: str = EXPORT_DIR, ttl: float = EXPORT_TTL):
+    """Removes export files older than ttl seconds"""
+    expired = time.time() - ttl
+    for entry in os.scandir(directory):
+        if entry.is_file() and entry.stat().st_mtime < expired:
+            try:
+                os.remove(entry.path)
+            except OSError as e:
+                logger.warning("Error removing old export %s: %s", entry.path, e)
@@ -0,0 +1,167 @@
+import bisect
+import re
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Dict, Iterable, List, Optional
+from config import FOOD_SUGGESTIONS, FOOD_INDEX_MAX_SIZE, FOOD_USER_INDEX_MAX_SIZE, FOOD_USER_INDEXES
+from models import UserProfile
+
+
+def normalize_food_name(name: str) -> str:
+    """
+    Normalizes food name for lookups, singular and plural forms get the same key
+
+    >>> normalize_food_name("  Apples ")
+    'apple'
+    >>> normalize_food_name("cookies") == normalize_food_name("Cookie")
+    True
+    >>> normalize_food_name("brownies") == normalize_food_name("brownie")
+    True
+    >>> normalize_food_name("smoothies") == normalize_food_name("smoothie")
+    True
+    >>> normalize_food_name("berries") == normalize_food_name("berry")
+    True
+    >>> normalize_food_name("pies") == normalize_food_name("pie")
+    True
+    """
+    words = re.sub(r"\s+", " ", name.strip().lower()).split(" ")
+    last = words[-1]
+    # Simple English plural forms, "-ies" is the plural of both "-y" and "-ie" words,
+    # so all three share the "-y" stem
+    if len(last) > 4 and last.endswith("ies"):
+        last = last[:-3] + "y"
+    elif len(last) > 4 and last.endswith("ie"):
+        last = last[:-2] + "y"
+    elif last.endswith(("oes", "ches", "shes", "xes", "sses")):
+        last = last[:-2]
+    elif len(last) > 3 and last.endswith("s") and not last.endswith(("ss", "us", "is")):
+        last = last[:-1]
+    words[-1] = last
+    return " ".join(words)
+
+
+@dataclass
+class FoodEntry:
+    """Food known from logged history"""
+    name: str  # display name
+    calories_per_100: float
+    count: int = 0  # times logged
+
+
+class FoodIndex:
+    """
+    Prefix index of foods with frequency counts.
+    Normalized names are kept in a sorted array, so prefix lookups are a binary search
+    followed by a scan of the matching range. With `max_size` new foods and aliases are
+    ignored once the index is full.
+    """
+    def __init__(self, max_size: Optional[int] = None):
+        self.max_size = max_size
+        self._entries: Dict[str, FoodEntry] = {}
+        self._keys: List[str] = []  # sorted normalized names
+        self._aliases: Dict[str, str] = {}  # normalized search query -> normalized name
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def add(self, name: str, calories_per_100: float, alias: Optional[str] = None):
+        """Records a logged food. Alias is the query the food was found by, if it differs from the name"""
+        key = normalize_food_name(name)
+        entry = self._entries.get(key)
+        if entry is None:
+            if self.max_size is not None and len(self._entries) >= self.max_size:
+                return
+            entry = self._entries[key] = FoodEntry(name=name.strip(), calories_per_100=calories_per_100)
+            bisect.insort(self._keys, key)
+        entry.calories_per_100 = calories_per_100  # keep the latest values
+        entry.count += 1
+        if alias is not None:
+            alias_key = normalize_food_name(alias)
+            full = self.max_size is not None and len(self._aliases) >= self.max_size
+            if alias_key != key and (alias_key in self._aliases or not full):
+                self._aliases[alias_key] = key
+
+    def get(self, name: str) -> Optional[FoodEntry]:
+        """Returns the food matching the name after normalization"""
+        key = normalize_food_name(name)
+        return self._entries.get(self._aliases.get(key, key))
+
+    def suggest(self, prefix: str = "", limit: int = FOOD_SUGGESTIONS) -> List[FoodEntry]:
+        """Returns the most frequently logged foods starting with the prefix"""
+        key = normalize_food_name(prefix) if prefix.strip() else ""
+        start = bisect.bisect_left(self._keys, key)
+        end = bisect.bisect_left(self._keys, key + "\uffff")
+        matches = (self._entries[k] for k in self._keys[start:end])
+        return sorted(matches, key=lambda entry: entry.count, reverse=True)[:limit]
+
+
+class FoodSuggestions:
+    """
+    Per-user and global food indexes built from `DailyStats.food_log`.
+    Only `max_users` recently used user indexes are kept, in LRU order.
+    """
+    def __init__(self, max_users: int = FOOD_USER_INDEXES):
+        self.max_users = max_users
+        self.global_index = FoodIndex(max_size=FOOD_INDEX_MAX_SIZE)
+        self._user_indexes: OrderedDict[int, FoodIndex] = OrderedDict()  # least recently used first
+
+    @staticmethod
+    def _iter_food_log(profile: UserProfile) -> Iterable[Dict]:
+        for stats in profile.daily_stats.values():
+            yield from stats.food_log
+
+    @staticmethod
+    def _calories_per_100(log: Dict) -> Optional[float]:
+        if "calories_per_100" in log:
+            return log["calories_per_100"]
+        # Entries logged before per-100 g values were stored
+        if log.get("weight"):
+            return log["calories"] * 100 / log["weight"]
+        return None
+
+    def rebuild(self, profiles: Iterable[UserProfile]):
+        """Builds the global index from history of all users"""
+        self.global_index = FoodIndex(max_size=FOOD_INDEX_MAX_SIZE)
+        self._user_indexes.clear()
+        for profile in profiles:
+            for log in self._iter_food_log(profile):
+                calories_per_100 = self._calories_per_100(log)
+                if calories_per_100 is not None:
+                    self.global_index.add(log["name"], calories_per_100)
+
+    def user_index(self, profile: UserProfile) -> FoodIndex:
+        """Returns the user index, building it from the user history on first access"""
+        index = self._user_indexes.get(profile.user_id)
+        if index is not None:
+            self._user_indexes.move_to_end(profile.user_id)
+            return index
+
+        index = self._user_indexes[profile.user_id] = FoodIndex(max_size=FOOD_USER_INDEX_MAX_SIZE)
+        for log in self._iter_food_log(profile):
+            calories_per_100 = self._calories_per_100(log)
+            if calories_per_100 is not None:
+                index.add(log["name"], calories_per_100)
+        if len(self._user_indexes) > self.max_users:
+            self._user_indexes.popitem(last=False)
+        return index
+
+    def record(self, profile: UserProfile, name: str, calories_per_100: float, query: Optional[str] = None):
+        """Adds a logged food to the user and global indexes"""
+        self.user_index(profile).add(name, calories_per_100, alias=query)
+        self.global_index.add(name, calories_per_100, alias=query)
+
+    def lookup(self, profile: UserProfile, name: str) -> Optional[FoodEntry]:
+        """Finds a known food by name, user history first"""
+        return self.user_index(profile).get(name) or self.global_index.get(name)
+
+    def suggest(self, profile: UserProfile, prefix: str = "", limit: int = FOOD_SUGGESTIONS) -> List[str]:
+        """Returns names of the best matching foods, user history first"""
+        names = [entry.name for entry in self.user_index(profile).suggest(prefix, limit)]
+        if prefix.strip() and len(names) < limit:
+            known = {normalize_food_name(name) for name in names}
+            for entry in self.global_index.suggest(prefix, limit):
+                if len(names) >= limit:
+                    break
+                if normalize_food_name(entry.name) not in known:
+                    names.append(entry.name)
+        return names
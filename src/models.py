@@ -1,12 +1,15 @@
 from dataclasses import dataclass, field
 from datetime import datetime
-from typing import Dict, List
-from config import WATER_PER_KG, WATER_PER_ACTIVITY, WATER_HOT_WEATHER
+from typing import Dict, Iterable, List, Optional, Tuple
+from config import (
+    WATER_PER_KG, WATER_PER_ACTIVITY, WATER_HOT_WEATHER, WATER_HOT_THRESHOLD, DEFAULT_TEMPERATURE, GOALS_VERSION
+)
+from day_index import DayIndex, current_day, day_iso, local_now
 
 
 @dataclass
 class DailyStats:  # pylint: disable=too-many-instance-attributes (R0902)
-    date: str  # ISO format date string
+    day: int  # day number (date.toordinal()) in the user's timezone
     logged_water: float = 0
     logged_calories: float = 0
     burned_calories: float = 0
@@ -15,37 +18,56 @@ class DailyStats:  # pylint: disable=too-many-instance-attributes (R0902)
     temperature: float = 0
     food_log: List[Dict] = field(default_factory=list)
     workout_log: List[Dict] = field(default_factory=list)
+    goals_key: Optional[Tuple] = field(default=None, repr=False, compare=False)  # inputs goals were computed from
+
+    @property
+    def date(self) -> str:
+        """ISO format date string"""
+        return day_iso(self.day)
 
 
 @dataclass
-class UserProfile:
+class UserProfile:  # pylint: disable=too-many-instance-attributes (R0902)
     user_id: int
     weight: float = 0
     height: float = 0
     age: int = 0
     activity_minutes: int = 0
     city: str = ""
-    daily_stats: Dict[str, DailyStats] = field(default_factory=dict)
+    utc_offset: int = 0  # seconds east of UTC in the user's city
+    daily_stats: DayIndex[DailyStats] = field(default_factory=DayIndex)
+
+    def today(self) -> int:
+        """Returns the current day number in the user's timezone"""
+        return current_day(self.utc_offset)
+
+    def now(self) -> datetime:
+        """Returns the current time in the user's timezone"""
+        return local_now(self.utc_offset)
+
+    def apply_weather(self, weather: Dict) -> float:
+        """Takes the UTC offset of the city from fetched weather (it changes with DST), returns the temperature"""
+        self.utc_offset = weather["utc_offset"]
+        return weather["temperature"]
+
+    def last_days(self, days: int) -> List[DailyStats]:
+        """Returns stats of the last `days` days including today, days without stats are skipped"""
+        return self.daily_stats.last(days, self.today())
 
     async def get_current_stats(self) -> DailyStats:
         """Gets or creates stats for current day"""
-        today = datetime.now().date().isoformat()
+        today = self.today()
         if today not in self.daily_stats:
             # Create new stats for the day
-            self.daily_stats[today] = DailyStats(date=today)
+            self.daily_stats[today] = DailyStats(day=today)
             # Initialize goals for new day
-            from utils import get_temperature  # pylint: disable=import-outside-toplevel (C0415)
+            from utils import get_weather  # pylint: disable=import-outside-toplevel (C0415)
             from config import WEATHER_API_KEY  # pylint: disable=import-outside-toplevel (C0415)
 
-            temp = await get_temperature(self.city, WEATHER_API_KEY)
-            if temp is not None:
-                await self.update_daily_goals(temp)
-            else:
-                # If failed to get temperature, use base goals
-                stats = self.daily_stats[today]
-                stats.water_goal = self.calculate_water_goal(20)  # Use 20°C as base temperature
-                stats.calorie_goal = self.calculate_calorie_goal()
-                stats.temperature = 20
+            weather = await get_weather(self.city, WEATHER_API_KEY)
+            # If failed to get temperature, use base goals
+            temp = self.apply_weather(weather) if weather is not None else DEFAULT_TEMPERATURE
+            self.refresh_goals(self.daily_stats[today], temp)
 
         return self.daily_stats[today]
 
@@ -53,7 +75,7 @@ class UserProfile:
         """Calculates daily water norm in ml"""
         base = self.weight * WATER_PER_KG  # base norm
         activity = (self.activity_minutes // 30) * WATER_PER_ACTIVITY  # +500ml every 30 minutes of activity
-        temp_addition = WATER_HOT_WEATHER if temperature > 25 else 0  # +500ml in hot weather
+        temp_addition = WATER_HOT_WEATHER if temperature > WATER_HOT_THRESHOLD else 0  # +500ml in hot weather
         return base + activity + temp_addition
 
     def calculate_calorie_goal(self) -> float:
@@ -62,9 +84,30 @@ class UserProfile:
         activity_calories = self.activity_minutes * 4  # approximately 4 calories per minute
         return bmr + activity_calories
 
-    async def update_daily_goals(self, temperature: float):
-        """Updates daily goals based on current conditions"""
-        stats = await self.get_current_stats()
+    def goals_key(self, temperature: float) -> Tuple:
+        """Returns all inputs the daily goals depend on"""
+        return (
+            GOALS_VERSION, self.weight, self.height, self.age, self.activity_minutes,
+            temperature > WATER_HOT_THRESHOLD  # only the temperature bucket affects the goals
+        )
+
+    def refresh_goals(self, stats: DailyStats, temperature: float) -> bool:
+        """Recomputes goals of the day if their inputs changed. Returns True if goals were recomputed"""
+        stats.temperature = temperature
+        key = self.goals_key(temperature)
+        if stats.goals_key == key:
+            return False
         stats.water_goal = self.calculate_water_goal(temperature)
         stats.calorie_goal = self.calculate_calorie_goal()
-        stats.temperature = temperature
+        stats.goals_key = key
+        return True
+
+
+def recompute_goals(profiles: Iterable[UserProfile]) -> int:
+    """Recomputes stale today's goals of all profiles (e.g. after goal constants changed)"""
+    recomputed = 0
+    for profile in profiles:
+        stats = profile.daily_stats.get(profile.today())
+        if stats is not None and profile.refresh_goals(stats, stats.temperature):
+            recomputed += 1
+    return recomputed
@@ -0,0 +1,322 @@
+import asyncio
+import os
+import pickle
+import sqlite3
+import threading
+import time
+from collections import Counter, OrderedDict
+from itertools import islice
+from typing import Dict, Iterable, Iterator, List, Optional, Set, Tuple
+from config import logger, PROFILES_DB, PROFILE_CACHE_SIZE, PROFILE_CACHE_TTL, PROFILE_CACHE_SWEEP_INTERVAL
+from models import UserProfile
+from snapshot import dump_profile, load_profile
+
+
+class ProfileStorage:
+    """SQLite storage of profiles evicted from memory. Blocking, should be used from threads"""
+    def __init__(self, path: str = PROFILES_DB):
+        self.path = path
+        self._conn: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+
+    def _connect(self) -> sqlite3.Connection:
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        conn = sqlite3.connect(self.path, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS profiles "
+            "(user_id INTEGER PRIMARY KEY, data BLOB NOT NULL, version INTEGER NOT NULL DEFAULT 0)"
+        )
+        columns = {row[1] for row in conn.execute("PRAGMA table_info(profiles)")}
+        if "version" not in columns:
+            # Databases created before rows were versioned
+            conn.execute("ALTER TABLE profiles ADD COLUMN version INTEGER NOT NULL DEFAULT 0")
+        return conn
+
+    def open(self) -> Tuple[Set[int], int]:
+        """Opens the database and returns IDs of all stored users and the latest row version"""
+        with self._lock:
+            self._conn = self._connect()
+            user_ids = {row[0] for row in self._conn.execute("SELECT user_id FROM profiles")}
+            version = self._conn.execute("SELECT COALESCE(MAX(version), 0) FROM profiles").fetchone()[0]
+            return user_ids, version
+
+    def close(self):
+        """Closes the database"""
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+    def load(self, user_id: int) -> Optional[UserProfile]:
+        """Loads a stored profile"""
+        with self._lock:
+            row = self._conn.execute("SELECT data FROM profiles WHERE user_id = ?", (user_id,)).fetchone()
+        return load_profile(pickle.loads(row[0])) if row else None
+
+    def versions(self) -> Dict[int, int]:
+        """Returns versions of stored profiles written with one"""
+        with self._lock:
+            return dict(self._conn.execute("SELECT user_id, version FROM profiles WHERE version > 0"))
+
+    def save_many(self, rows: List[Tuple[int, bytes, int]]):
+        """Saves serialized profiles with their versions"""
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO profiles (user_id, data, version) VALUES (?, ?, ?)", rows
+            )
+
+    def iter_profiles(self, skip: Set[int]) -> Iterator[UserProfile]:
+        """Yields stored profiles except the skipped ones, using a separate connection"""
+        conn = sqlite3.connect(self.path)
+        try:
+            for user_id, data in conn.execute("SELECT user_id, data FROM profiles"):
+                if user_id not in skip:
+                    yield load_profile(pickle.loads(data))
+        finally:
+            conn.close()
+
+
+def serialize_profile(profile: UserProfile) -> bytes:
+    """Serializes profile for the storage"""
+    return pickle.dumps(dump_profile(profile), protocol=pickle.HIGHEST_PROTOCOL)
+
+
+class ProfileCache:  # pylint: disable=too-many-instance-attributes (R0902)
+    """
+    Cache of recently active user profiles.
+    Profiles are kept in LRU order and evicted when the cache exceeds `max_size` or when
+    they were not accessed for `ttl` seconds. Changed (dirty) profiles are written back to
+    the storage on eviction. Concurrent loads of the same profile share a single storage read.
+    Profiles pinned by running handlers are not evicted, so their changes are not lost.
+    Stored rows, state snapshots and journal records are ordered by a common sequence number,
+    so restore never applies saved state older than the stored profile.
+    """
+    def __init__(
+            self,
+            storage: ProfileStorage,
+            max_size: int = PROFILE_CACHE_SIZE,
+            ttl: float = PROFILE_CACHE_TTL
+    ):
+        self._storage = storage
+        self.max_size = max_size
+        self.ttl = ttl
+        self._resident: OrderedDict[int, UserProfile] = OrderedDict()  # least recently used first
+        self._accessed: Dict[int, float] = {}
+        self._dirty: Set[int] = set()
+        self._evicting: Dict[int, UserProfile] = {}  # evicted profiles being written to the storage
+        self._loading: Dict[int, asyncio.Future] = {}
+        self._known: Set[int] = set()  # IDs of all users, resident or stored
+        self._pinned: Counter = Counter()  # user_id -> handlers using the profile
+        self._write_tasks: Set[asyncio.Task] = set()
+        self.sequence = 0  # next sequence number, stored rows are stamped with it
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    async def open(self):
+        """Opens the storage"""
+        user_ids, version = await asyncio.to_thread(self._storage.open)
+        self._known |= user_ids
+        self.advance_sequence(version)
+
+    def next_sequence(self) -> int:
+        """Takes a sequence number for saved state, rows stored after it get a greater version"""
+        self.sequence += 1
+        return self.sequence - 1
+
+    def advance_sequence(self, sequence: int):
+        """Makes sure the next sequence number is not less than the given one"""
+        self.sequence = max(self.sequence, sequence)
+
+    def stored_versions(self) -> Dict[int, int]:
+        """Returns versions of stored profiles. Blocking, for use at startup"""
+        return self._storage.versions()
+
+    async def close(self):
+        """Writes all dirty profiles to the storage and closes it"""
+        await asyncio.gather(*self._write_tasks, return_exceptions=True)
+        rows = [(user_id, serialize_profile(self._resident[user_id]), self.sequence) for user_id in self._dirty]
+        if rows:
+            await asyncio.to_thread(self._storage.save_many, rows)
+        self._dirty.clear()
+        await asyncio.to_thread(self._storage.close)
+
+    def __contains__(self, user_id: int) -> bool:
+        return user_id in self._known
+
+    def __len__(self) -> int:
+        return len(self._known)
+
+    def peek(self, user_id: int) -> Optional[UserProfile]:
+        """Returns the profile if it is in memory, without loading it or updating LRU order"""
+        return self._resident.get(user_id) or self._evicting.get(user_id)
+
+    def resident(self) -> List[UserProfile]:
+        """Returns profiles kept in memory, including evicted ones not yet written to the storage"""
+        return list(self._resident.values()) + list(self._evicting.values())
+
+    def iter_all(self) -> Iterator[UserProfile]:
+        """
+        Returns iterator over all profiles without caching them.
+        Resident profiles are collected on the call, stored ones are read while iterating
+        (blocking, should be consumed in a thread)
+        """
+        return self._iter_all(self.resident())
+
+    def _iter_all(self, resident: List[UserProfile]) -> Iterator[UserProfile]:
+        yield from resident
+        yield from self._storage.iter_profiles({profile.user_id for profile in resident})
+
+    async def get(self, user_id: int, promote: bool = True) -> Optional[UserProfile]:
+        """Returns the profile, loading it from the storage if needed. With promote=False it is not cached"""
+        profile = self._resident.get(user_id)
+        if profile is not None:
+            self.hits += 1
+            self._touch(user_id)
+            return profile
+
+        profile = self._evicting.get(user_id)
+        if profile is not None:
+            self.hits += 1
+            if promote:
+                self._insert(profile)
+            return profile
+
+        if user_id not in self._known:
+            return None
+
+        loading = self._loading.get(user_id)
+        if loading is not None:
+            # Someone is already loading this profile, share the result.
+            # The load could have been started with promote=False, so the profile may be not cached yet
+            profile = await asyncio.shield(loading)
+            if profile is not None and promote and user_id not in self._resident:
+                profile = self.peek(user_id) or profile
+                self._insert(profile)
+            return profile
+
+        self.misses += 1
+        loading = self._loading[user_id] = asyncio.get_running_loop().create_future()
+        try:
+            profile = await asyncio.to_thread(self._storage.load, user_id)
+            # The profile could have been replaced while loading
+            profile = self.peek(user_id) or profile
+            if profile is not None and promote:
+                self._insert(profile)
+            loading.set_result(profile)
+            return profile
+        except asyncio.CancelledError:
+            loading.cancel()
+            raise
+        except Exception as e:
+            loading.set_exception(e)
+            loading.exception()  # waiters re-raise it, don't log as unretrieved
+            raise
+        finally:
+            del self._loading[user_id]
+
+    def load_stored(self, user_id: int) -> Optional[UserProfile]:
+        """Loads a stored profile without caching it. Blocking, should be called from a thread"""
+        return self._storage.load(user_id)
+
+    def put(self, profile: UserProfile):
+        """Adds a new or replaced profile"""
+        self._known.add(profile.user_id)
+        self._evicting.pop(profile.user_id, None)
+        self._insert(profile)
+        self._dirty.add(profile.user_id)
+
+    def pin(self, user_id: int):
+        """Keeps the profile in memory (once loaded) until it is unpinned"""
+        self._pinned[user_id] += 1
+
+    def unpin(self, user_id: int):
+        """Releases a pin, the profile may be evicted again when no pins are left"""
+        self._pinned[user_id] -= 1
+        if self._pinned[user_id] <= 0:
+            del self._pinned[user_id]
+
+    def mark_dirty(self, user_id: int):
+        """Marks resident profile as changed, so it is written back on eviction"""
+        if user_id in self._resident:
+            self._dirty.add(user_id)
+
+    def _touch(self, user_id: int):
+        self._resident.move_to_end(user_id)
+        self._accessed[user_id] = time.monotonic()
+
+    def _insert(self, profile: UserProfile):
+        self._resident[profile.user_id] = profile
+        self._touch(profile.user_id)
+        if len(self._resident) > self.max_size:
+            # Pinned profiles are skipped, the cache may exceed max_size while they are in use
+            unpinned = (user_id for user_id in self._resident if user_id not in self._pinned)
+            self._evict(list(islice(unpinned, len(self._resident) - self.max_size)))
+
+    def evict_expired(self):
+        """Evicts profiles not accessed for `ttl` seconds"""
+        expired = time.monotonic() - self.ttl
+        user_ids = []
+        for user_id in self._resident:  # least recently used first
+            if self._accessed[user_id] >= expired:
+                break
+            if user_id not in self._pinned:
+                user_ids.append(user_id)
+        if user_ids:
+            self._evict(user_ids)
+
+    def _evict(self, user_ids: Iterable[int]):
+        rows = []
+        for user_id in user_ids:
+            profile = self._resident.pop(user_id)
+            del self._accessed[user_id]
+            self.evictions += 1
+            if user_id in self._dirty:
+                self._dirty.discard(user_id)
+                # Serialized on the event loop, so the written state is consistent
+                rows.append((user_id, serialize_profile(profile), self.sequence))
+                self._evicting[user_id] = profile
+        if rows:
+            task = asyncio.create_task(self._write_back(rows))
+            self._write_tasks.add(task)
+            task.add_done_callback(self._write_tasks.discard)
+
+    async def _write_back(self, rows: List[Tuple[int, bytes, int]]):
+        try:
+            await asyncio.to_thread(self._storage.save_many, rows)
+        except Exception as e:
+            logger.error("Error writing back %s profiles: %s", len(rows), e)
+            # Keep profiles in memory, they will be written on the next eviction
+            for user_id, *_ in rows:
+                profile = self._evicting.get(user_id)
+                if profile is not None and user_id not in self._resident:
+                    self._insert(profile)
+                    self._dirty.add(user_id)
+        finally:
+            for user_id, *_ in rows:
+                self._evicting.pop(user_id, None)
+
+    def stats(self) -> Dict[str, float]:
+        """Returns cache statistics"""
+        requests = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / requests if requests else 0,
+            "evictions": self.evictions,
+            "resident": len(self._resident),
+            "resident_days": sum(len(profile.daily_stats) for profile in self._resident.values()),
+            "dirty": len(self._dirty),
+            "known": len(self._known),
+        }
+
+    async def run(self, interval: float = PROFILE_CACHE_SWEEP_INTERVAL):
+        """Evicts inactive profiles periodically until cancelled"""
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                self.evict_expired()
+                logger.debug("Profile cache: %s", self.stats())
+            except Exception as e:
+                logger.error("Error evicting profiles: %s", e)
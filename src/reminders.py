@@ -0,0 +1,195 @@
+import asyncio
+import heapq
+import json
+import os
+import time
+from datetime import datetime, timedelta
+from typing import TYPE_CHECKING, Dict, List, Tuple
+from config import (
+    logger, REMINDER_INTERVAL, REMINDER_START_HOUR, REMINDER_END_HOUR, REMINDER_INACTIVE_DAYS, REMINDER_BATCH_SIZE,
+    REMINDER_SAVE_INTERVAL, REMINDERS_FILE
+)
+from day_index import day_number, user_timezone
+from delivery import DeliveryQueue
+
+if TYPE_CHECKING:
+    from profile_cache import ProfileCache
+
+
+class ReminderScheduler:  # pylint: disable=too-many-instance-attributes (R0902)
+    """
+    Proactive water and logging reminders.
+    Pending reminders are kept in a heap keyed by due time, so each tick only
+    touches users whose reminder is due, in batches of `batch_size`.
+    """
+    def __init__(
+            self,
+            profiles: "ProfileCache",
+            outbox: DeliveryQueue,
+            path: str = REMINDERS_FILE,
+            interval: float = REMINDER_INTERVAL,
+            batch_size: int = REMINDER_BATCH_SIZE
+    ):
+        self._profiles = profiles
+        self._outbox = outbox
+        self.path = path
+        self.interval = interval
+        self.batch_size = batch_size
+        self._heap: List[Tuple[float, int]] = []  # (due timestamp, user_id), may contain stale entries
+        self._due: Dict[int, float] = {}  # actual due timestamp of each user
+        self._dirty = False
+        self._wakeup = asyncio.Event()
+
+    def __len__(self) -> int:
+        return len(self._due)
+
+    def __contains__(self, user_id: int) -> bool:
+        return user_id in self._due
+
+    def schedule(self, user_id: int, due: float | None = None):
+        """Schedules (or reschedules) the next reminder check for the user"""
+        if due is None:
+            due = time.time() + self.interval
+        self._due[user_id] = due
+        heapq.heappush(self._heap, (due, user_id))
+        self._dirty = True
+        if self._heap[0] == (due, user_id):
+            self._wakeup.set()
+        # Drop stale entries left by rescheduling
+        if len(self._heap) > 2 * len(self._due) + self.batch_size:
+            self._heap = [(d, uid) for uid, d in self._due.items()]
+            heapq.heapify(self._heap)
+
+    def cancel(self, user_id: int):
+        """Removes pending reminder of the user"""
+        if self._due.pop(user_id, None) is not None:
+            self._dirty = True
+
+    def resume(self, user_id: int):
+        """Schedules reminders of an active user unless they are already pending"""
+        if user_id not in self._due:
+            self.schedule(user_id)
+
+    def load(self):
+        """Loads pending reminders saved by the previous run"""
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            logger.error("Error loading reminders: %s", e)
+            return
+        self._due = {int(user_id): float(due) for user_id, due in data.items()}
+        self._heap = [(due, user_id) for user_id, due in self._due.items()]
+        heapq.heapify(self._heap)
+        logger.info("Loaded %s pending reminders", len(self._due))
+
+    def save(self):
+        """Saves pending reminders"""
+        self._write(dict(self._due))
+        self._dirty = False
+
+    def _write(self, due: Dict[int, float]):
+        # Write to a temporary file first, so a crash never leaves a truncated file
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(due, f)
+        os.replace(tmp_path, self.path)
+
+    async def run(self):
+        """Processes due reminders until cancelled"""
+        last_save = time.time()
+        try:
+            while True:
+                now = time.time()
+                processed = await self._process_due(now)
+
+                if self._dirty and now - last_save >= REMINDER_SAVE_INTERVAL:
+                    self._dirty = False
+                    await asyncio.to_thread(self._write, dict(self._due))
+                    last_save = now
+
+                if processed >= self.batch_size:
+                    await asyncio.sleep(0)  # more reminders are due, let handlers run in between
+                    continue
+
+                delay = REMINDER_SAVE_INTERVAL
+                if self._heap:
+                    delay = min(delay, max(0.0, self._heap[0][0] - now))
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            self.save()
+
+    async def _process_due(self, now: float) -> int:
+        """Processes up to `batch_size` due reminders, returns their number"""
+        processed = 0
+        while self._heap and self._heap[0][0] <= now and processed < self.batch_size:
+            due, user_id = heapq.heappop(self._heap)
+            if self._due.get(user_id) != due:
+                continue  # stale entry
+            processed += 1
+            try:
+                await self._remind(user_id, now)
+            except Exception as e:
+                logger.error("Error processing reminder for user %s: %s", user_id, e)
+                self.schedule(user_id, now + self.interval)
+        return processed
+
+    async def _remind(self, user_id: int, now: float):
+        """Sends a reminder if the user is behind and schedules the next one"""
+        if user_id not in self._profiles:
+            self.cancel(user_id)
+            return
+
+        # Inactive users are read from the storage without pushing active ones out of the cache
+        profile = await self._profiles.get(user_id, promote=False)
+
+        # Reminder window is in the user's local time
+        current = datetime.fromtimestamp(now, user_timezone(profile.utc_offset))
+        window_start = current.replace(hour=REMINDER_START_HOUR, minute=0, second=0, microsecond=0)
+        window_end = current.replace(hour=REMINDER_END_HOUR, minute=0, second=0, microsecond=0)
+        if current < window_start:
+            self.schedule(user_id, window_start.timestamp())
+            return
+        if current >= window_end:
+            self.schedule(user_id, (window_start + timedelta(days=1)).timestamp())
+            return
+
+        today = day_number(current.date())
+        stats = profile.daily_stats.get(today)
+        if stats is None:
+            last_active = profile.daily_stats.latest()
+            if last_active is None or today - last_active > REMINDER_INACTIVE_DAYS:
+                # User stopped using the bot, reminders resume when they come back
+                self.cancel(user_id)
+                return
+            self._outbox.send_message(
+                user_id,
+                "👋 You haven't logged anything today.\n"
+                "Use /log_water, /log_food or /log_workout to keep track of your progress."
+            )
+            # Logging nudge is sent once a day
+            self.schedule(user_id, (window_start + timedelta(days=1)).timestamp())
+            return
+        if stats.water_goal > 0:
+            if stats.logged_water >= stats.water_goal:
+                # Goal reached, nothing to remind about until tomorrow
+                self.schedule(user_id, (window_start + timedelta(days=1)).timestamp())
+                return
+            # Water goal is spread evenly over the reminder window
+            expected = stats.water_goal * (current - window_start) / (window_end - window_start)
+            if stats.logged_water < expected:
+                self._outbox.send_message(
+                    user_id,
+                    "💧 Time to drink some water!\n"
+                    f"Drunk: {stats.logged_water:.0f} ml out of {stats.water_goal:.0f} ml.\n"
+                    f"Remaining: {stats.water_goal - stats.logged_water:.0f} ml.\n"
+                    "Use /log_water <ml> to log it."
+                )
+        self.schedule(user_id, now + self.interval)
@@ -0,0 +1,77 @@
+from dataclasses import dataclass
+from enum import Enum
+from typing import Optional
+from aiogram.filters import BaseFilter, CommandObject
+from aiogram.types import Message
+
+
+class CommandName(Enum):
+    """Bot commands"""
+    START = "start"
+    HELP = "help"
+    SET_PROFILE = "set_profile"
+    LOG_WATER = "log_water"
+    LOG_FOOD = "log_food"
+    LOG_WORKOUT = "log_workout"
+    CHECK_PROGRESS = "check_progress"
+    CHARTS = "charts"
+    HISTORY = "history"
+    EXPORT = "export"
+    EXPORT_ALL = "export_all"
+    ANALYTICS = "analytics"
+
+
+COMMANDS = {command.value: command for command in CommandName}
+
+# Commands available to users without profile (admin commands check permissions themselves)
+COMMANDS_WITHOUT_PROFILE = frozenset({
+    CommandName.START, CommandName.HELP, CommandName.SET_PROFILE, CommandName.EXPORT_ALL, CommandName.ANALYTICS
+})
+
+
+def state_group(state: Optional[str]) -> Optional[str]:
+    """Returns the states group of a raw FSM state: "FoodLogging:waiting_for_weight" -> "FoodLogging\""""
+    return state.split(":", 1)[0] if state else None
+
+
+@dataclass
+class Route:
+    """Classification of a message, computed once per update"""
+    command: Optional[CommandName]  # None for plain text, unknown commands and commands to other bots
+    args: Optional[str]
+    has_profile: bool
+    state: Optional[str] = None  # raw FSM state, set after the state is loaded
+
+    @property
+    def allowed_without_profile(self) -> bool:
+        """Checks if the message can be handled for a user without profile"""
+        return self.command in COMMANDS_WITHOUT_PROFILE
+
+    @property
+    def state_group(self) -> Optional[str]:
+        """FSM states group of the user, e.g. "FoodLogging\""""
+        return state_group(self.state)
+
+
+def classify_message(text: Optional[str], has_profile: bool, bot_username: Optional[str] = None) -> Route:
+    """Parses command and its arguments: "/log_water@bot 250" -> (LOG_WATER, "250")"""
+    if not text or not text.startswith("/"):
+        return Route(command=None, args=None, has_profile=has_profile)
+    head, *args = text.split(maxsplit=1)
+    name, _, mention = head[1:].partition("@")
+    # Commands addressed to another bot in a group are plain text for this one, like with the aiogram Command filter
+    if mention and (bot_username is None or mention.lower() != bot_username.lower()):
+        return Route(command=None, args=None, has_profile=has_profile)
+    return Route(command=COMMANDS.get(name), args=args[0] if args else None, has_profile=has_profile)
+
+
+class RouteCommand(BaseFilter):  # pylint: disable=too-few-public-methods (R0903)
+    """Command filter using the precomputed route instead of parsing the message again"""
+    def __init__(self, command: CommandName):
+        self.command = command
+
+    async def __call__(self, message: Message, route: Route) -> bool | dict:
+        if route.command is not self.command:
+            return False
+        # Handlers get the same CommandObject as with the aiogram Command filter
+        return {"command": CommandObject(prefix="/", command=self.command.value, args=route.args)}
@@ -0,0 +1,438 @@
+import asyncio
+import itertools
+import math
+import random
+import threading
+import time
+import zlib
+from collections import Counter, defaultdict, deque
+from dataclasses import dataclass
+from typing import Any, Awaitable, Callable, Deque, Dict, List, Optional
+from aiohttp import web
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+from config import (
+    logger, WORKOUT_CALORIES, SIM_HOST, SIM_PORT, SIM_SEED, SIM_USERS, SIM_ACTIONS, SIM_THINK_TIME,
+    SIM_REPLY_TIMEOUT, SIM_SERVICES
+)
+from delivery import TokenBucket
+
+BOT_USER = {"id": 123456, "is_bot": True, "first_name": "Fitness Bot", "username": "fitness_simulation_bot"}
+
+# Cities known to the stub weather service: name -> UTC offset in seconds, other cities are not found
+STUB_CITIES = {
+    "Moscow": 3 * 3600,
+    "London": 0,
+    "New York": -4 * 3600,
+    "Tokyo": 9 * 3600,
+    "Sydney": 11 * 3600,
+    "Los Angeles": -7 * 3600,
+    "Delhi": 5 * 3600 + 1800,
+}
+
+# Foods known to the stub FatSecret: name -> kcal per 100 g
+STUB_FOODS = {
+    "apple": 52,
+    "banana": 89,
+    "bread": 265,
+    "rice": 130,
+    "chicken breast": 165,
+    "egg": 155,
+    "oatmeal": 68,
+    "milk": 42,
+    "cheese": 402,
+    "salmon": 208,
+}
+
+# Mix of actions of virtual users after profile setup: action -> weight
+SIM_ACTION_WEIGHTS = {
+    "log_water": 35,
+    "log_food": 25,
+    "log_workout": 10,
+    "check_progress": 15,
+    "history": 10,
+    "charts": 5,
+}
+SETUP_ATTEMPTS = 3  # times a virtual user enters the city if the weather service fails
+
+
+class StubServiceError(Exception):
+    """Failure injected by a stub service"""
+
+
+@dataclass
+class Outcome:
+    """Simulated outcome of a call to a stub service"""
+    latency: float = 0
+    failure: Optional[str] = None  # "error" or "rate_limit"
+    retry_after: int = 0  # seconds, for rate limited calls
+
+
+class StubService:  # pylint: disable=too-many-instance-attributes (R0902)
+    """
+    Latency, error rate and rate limit of a stubbed external service.
+    The outcome of the n-th call for a key (chat, city, food query) is derived from the seed,
+    the service name, the key and n, so it doesn't depend on how concurrent calls interleave.
+    Only rate limiting depends on timing. Calls may come from the event loop and threads.
+    """
+    def __init__(self, name: str, latency: float, error_rate: float, rate_limit: float):
+        self.name = name
+        self.latency = latency
+        self.error_rate = error_rate
+        self._bucket = TokenBucket(rate_limit, rate_limit) if rate_limit > 0 else None
+        self._key_calls: Counter = Counter()  # key -> calls that passed the rate limit
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.errors = 0
+        self.throttled = 0
+
+    def draw(self, key: str) -> Outcome:
+        """Decides latency and failure of the next call for the key"""
+        with self._lock:
+            self.calls += 1
+            if self._bucket is not None:
+                now = time.monotonic()
+                delay = self._bucket.delay(now)
+                if delay > 0:
+                    # Throttled calls don't advance the key, its retry gets the outcome the call would have got
+                    self.throttled += 1
+                    return Outcome(failure="rate_limit", retry_after=max(1, math.ceil(delay)))
+                self._bucket.consume(now)
+            n = self._key_calls[key]
+            self._key_calls[key] += 1
+
+        rng = random.Random(f"{SIM_SEED}:{self.name}:{key}:{n}")
+        latency = rng.expovariate(1 / self.latency) if self.latency > 0 else 0
+        if rng.random() < self.error_rate:
+            with self._lock:
+                self.errors += 1
+            return Outcome(latency=latency, failure="error")
+        return Outcome(latency=latency)
+
+
+SERVICES = {name: StubService(name, *limits) for name, limits in SIM_SERVICES.items()}
+
+
+class StubFatsecret:
+    """Offline replacement of the FatSecret client with the methods used by the bot. Blocking, like the real one"""
+    def __init__(self, service: Optional[StubService] = None):
+        self._service = service or SERVICES["fatsecret"]
+        self._foods = list(STUB_FOODS)
+
+    def _call(self, key: str):
+        outcome = self._service.draw(key)
+        time.sleep(outcome.latency)
+        if outcome.failure is not None:
+            raise StubServiceError(f"FatSecret {outcome.failure.replace('_', ' ')}")
+
+    def foods_search(self, search_expression: str) -> List[Dict]:
+        """Finds foods containing the search expression"""
+        query = search_expression.strip().lower()
+        self._call(f"search:{query}")
+        return [
+            {"food_id": str(food_id), "food_name": name.title()}
+            for food_id, name in enumerate(self._foods) if query in name or name in query
+        ]
+
+    def food_get_v2(self, food_id: str) -> Dict:
+        """Returns food details with a 100 g serving"""
+        self._call(f"food:{food_id}")
+        name = self._foods[int(food_id)]
+        return {
+            "food_id": food_id,
+            "food_name": name.title(),
+            "servings": {"serving": [{
+                "metric_serving_amount": "100.000",
+                "metric_serving_unit": "g",
+                "calories": str(STUB_FOODS[name]),
+                "protein": "1.0",
+                "fat": "1.0",
+                "carbohydrate": "10.0",
+            }]},
+        }
+
+
+class StubBotAPI:  # pylint: disable=too-many-instance-attributes (R0902)
+    """
+    In-process stub of the Telegram Bot API (getUpdates, sendMessage, sendPhoto, sendDocument)
+    and the OpenWeatherMap current weather endpoint.
+    Send methods are subject to the "telegram" service latency, errors and rate limit.
+    """
+    def __init__(self, host: str = SIM_HOST, port: int = SIM_PORT):
+        self.host = host
+        self.port = port
+        self.on_message: Optional[Callable[[int, Dict], None]] = None  # called for every message sent by the bot
+        self.sent: Counter = Counter()  # method -> messages sent by the bot
+        self._updates: Deque[Dict] = deque()
+        self._new_updates = asyncio.Event()
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1)
+        self._runner: Optional[web.AppRunner] = None
+        self._methods = {
+            "sendmessage": self._send_message,
+            "sendphoto": self._send_photo,
+            "senddocument": self._send_document,
+        }
+
+    @property
+    def api_server(self) -> TelegramAPIServer:
+        """Bot API server config for aiogram sessions"""
+        return TelegramAPIServer.from_base(f"http://{self.host}:{self.port}")
+
+    async def start(self):
+        """Starts the HTTP server"""
+        app = web.Application()
+        app.router.add_route("*", "/bot{token}/{method}", self._handle_bot)
+        app.router.add_get("/data/2.5/weather", self._handle_weather)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.host, self.port).start()
+        logger.info("Stub Bot API and weather server started on %s:%s", self.host, self.port)
+
+    async def stop(self):
+        """Stops the HTTP server"""
+        self._new_updates.set()  # release pending long polls
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    def push_message(self, user_id: int, text: str) -> int:
+        """Queues a private message from a user, returns the update ID"""
+        update_id = next(self._update_ids)
+        self._updates.append({
+            "update_id": update_id,
+            "message": {
+                "message_id": next(self._message_ids),
+                "date": int(time.time()),
+                "chat": {"id": user_id, "type": "private"},
+                "from": {"id": user_id, "is_bot": False, "first_name": f"User {user_id}"},
+                "text": text,
+            },
+        })
+        self._new_updates.set()
+        return update_id
+
+    # Bot API
+
+    @staticmethod
+    def _ok(result: Any) -> web.Response:
+        return web.json_response({"ok": True, "result": result})
+
+    @staticmethod
+    def _error(code: int, description: str, **parameters) -> web.Response:
+        body = {"ok": False, "error_code": code, "description": description}
+        if parameters:
+            body["parameters"] = parameters
+        return web.json_response(body, status=code)
+
+    async def _handle_bot(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"].lower()
+        params = dict(await request.post())
+        if method == "getupdates":
+            return self._ok(await self._get_updates(params))
+        if method == "getme":
+            return self._ok(BOT_USER)
+        handler = self._methods.get(method)
+        if handler is None:
+            return self._error(404, "Not Found: method not found")
+
+        outcome = SERVICES["telegram"].draw(f"chat:{params.get('chat_id')}")
+        if outcome.failure == "rate_limit":
+            return self._error(
+                429, f"Too Many Requests: retry after {outcome.retry_after}", retry_after=outcome.retry_after
+            )
+        await asyncio.sleep(outcome.latency)
+        if outcome.failure == "error":
+            return self._error(500, "Internal Server Error")
+        self.sent[method] += 1
+        return self._ok(handler(params))
+
+    async def _get_updates(self, params: Dict) -> List[Dict]:
+        # Updates before the offset are confirmed by the bot
+        offset = int(params.get("offset", 0))
+        while self._updates and self._updates[0]["update_id"] < offset:
+            self._updates.popleft()
+        timeout = float(params.get("timeout", 0))
+        if not self._updates and timeout > 0:
+            self._new_updates.clear()
+            try:
+                await asyncio.wait_for(self._new_updates.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        return list(itertools.islice(self._updates, int(params.get("limit", 100))))
+
+    def _message(self, params: Dict, **content) -> Dict:
+        chat_id = int(params["chat_id"])
+        message = {
+            "message_id": next(self._message_ids),
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "from": BOT_USER,
+            **content,
+        }
+        if self.on_message is not None:
+            self.on_message(chat_id, message)
+        return message
+
+    def _send_message(self, params: Dict) -> Dict:
+        return self._message(params, text=params.get("text", ""))
+
+    def _send_photo(self, params: Dict) -> Dict:
+        file_id = f"photo{next(self._message_ids)}"
+        photo = [{"file_id": file_id, "file_unique_id": file_id, "width": 1000, "height": 1200}]
+        return self._message(params, photo=photo, caption=params.get("caption"))
+
+    def _send_document(self, params: Dict) -> Dict:
+        file_id = f"document{next(self._message_ids)}"
+        document = {"file_id": file_id, "file_unique_id": file_id}
+        return self._message(params, document=document, caption=params.get("caption"))
+
+    # Weather
+
+    async def _handle_weather(self, request: web.Request) -> web.Response:
+        city = request.query.get("q", "").strip().lower()
+        outcome = SERVICES["weather"].draw(f"city:{city}")
+        if outcome.failure == "rate_limit":
+            return web.json_response({"cod": 429, "message": "Too many requests"}, status=429)
+        await asyncio.sleep(outcome.latency)
+        if outcome.failure == "error":
+            return web.json_response({"cod": 503, "message": "Service unavailable"}, status=503)
+
+        name = next((known for known in STUB_CITIES if known.lower() == city), None)
+        if name is None:
+            return web.json_response({"cod": "404", "message": "city not found"}, status=404)
+        # Temperature of a city depends only on the seed, from -10 to 35 °C
+        seed = zlib.crc32(f"{SIM_SEED}:{name}".encode())
+        return web.json_response({
+            "main": {"temp": -10 + seed % 451 / 10},
+            "timezone": STUB_CITIES[name],
+            "name": name,
+            "cod": 200,
+        })
+
+
+class Simulation:  # pylint: disable=too-many-instance-attributes (R0902)
+    """
+    Offline run of the bot against the stub server.
+    Virtual users set up profiles and then send a seeded random mix of commands. Each user
+    waits for the bot's reply before the next message, so reply latency is measured per
+    command under the configured service latency, errors and rate limits.
+    """
+    def __init__(
+            self,
+            users: int = SIM_USERS,
+            actions: int = SIM_ACTIONS,
+            think_time: float = SIM_THINK_TIME,
+            reply_timeout: float = SIM_REPLY_TIMEOUT
+    ):
+        self.server = StubBotAPI()
+        self.server.on_message = self._on_message
+        self.users = users
+        self.actions = actions
+        self.think_time = think_time
+        self.reply_timeout = reply_timeout
+        self._waiting: Dict[int, asyncio.Future] = {}  # user_id -> next reply
+        self.latencies: Dict[str, List[float]] = defaultdict(list)  # command -> reply latencies
+        self.timeouts: Counter = Counter()  # command -> messages left without reply
+
+    def session(self) -> AiohttpSession:
+        """Returns aiogram session connected to the stub server"""
+        return AiohttpSession(api=self.server.api_server)
+
+    async def start(self):
+        """Starts the stub server"""
+        await self.server.start()
+
+    async def stop(self):
+        """Stops the stub server"""
+        await self.server.stop()
+
+    async def run(self, on_finished: Optional[Callable[[], Awaitable]] = None):
+        """Runs all virtual users, logs the report and calls `on_finished`"""
+        start = time.monotonic()
+        await asyncio.gather(*(self._run_user(1_000_000 + n) for n in range(self.users)))
+        logger.info("Simulation finished in %.1f s\n%s", time.monotonic() - start, self.report())
+        if on_finished is not None:
+            await on_finished()
+
+    def _on_message(self, chat_id: int, message: Dict):
+        reply = self._waiting.pop(chat_id, None)
+        if reply is not None and not reply.done():
+            reply.set_result(message.get("text") or message.get("caption") or "")
+
+    async def _ask(self, user_id: int, text: str) -> Optional[str]:
+        """Sends a message and waits for the reply, returns None if there was no reply"""
+        command = text.split(maxsplit=1)[0] if text.startswith("/") else "(answer)"
+        reply = self._waiting[user_id] = asyncio.get_running_loop().create_future()
+        start = time.monotonic()
+        self.server.push_message(user_id, text)
+        try:
+            result = await asyncio.wait_for(reply, self.reply_timeout)
+        except asyncio.TimeoutError:
+            self._waiting.pop(user_id, None)
+            self.timeouts[command] += 1
+            return None
+        self.latencies[command].append(time.monotonic() - start)
+        return result
+
+    async def _converse(self, user_id: int, steps: List[str]) -> Optional[str]:
+        """Sends messages of a dialog while the bot keeps asking, returns the last reply"""
+        reply = None
+        for step in steps:
+            reply = await self._ask(user_id, step)
+            # The next step answers a question, stop if the bot didn't ask one
+            if reply is None or not reply.rstrip().endswith(("?", ":")):
+                break
+        return reply
+
+    async def _run_user(self, user_id: int):
+        rng = random.Random(f"{SIM_SEED}:{user_id}")
+        await asyncio.sleep(rng.uniform(0, 2 * self.think_time))  # users don't come all at once
+
+        city = rng.choice(list(STUB_CITIES))
+        await self._ask(user_id, "/start")
+        reply = await self._converse(user_id, [
+            "/set_profile", str(rng.randint(50, 110)), str(rng.randint(150, 200)), str(rng.randint(18, 70)),
+            str(rng.choice([0, 30, 60, 90])), city
+        ])
+        for _ in range(SETUP_ATTEMPTS - 1):
+            if reply is None or not reply.startswith("❌"):
+                break
+            reply = await self._ask(user_id, city)
+
+        for _ in range(self.actions):
+            await asyncio.sleep(rng.expovariate(1 / self.think_time) if self.think_time > 0 else 0)
+            await self._converse(user_id, self._action(rng))
+
+    @staticmethod
+    def _action(rng: random.Random) -> List[str]:
+        """Picks the next dialog of a virtual user"""
+        action = rng.choices(list(SIM_ACTION_WEIGHTS), weights=list(SIM_ACTION_WEIGHTS.values()))[0]
+        if action == "log_water":
+            return [f"/log_water {rng.choice([150, 200, 250, 330, 500])}"]
+        if action == "log_food":
+            return [f"/log_food {rng.choice(list(STUB_FOODS))}", str(rng.randint(50, 300))]
+        if action == "log_workout":
+            return [f"/log_workout {rng.choice(list(WORKOUT_CALORIES))}", str(rng.choice([15, 30, 45, 60]))]
+        if action == "history":
+            return ["/history", str(rng.choice([1, 7, 30]))]
+        return [f"/{action}"]
+
+    def report(self) -> str:
+        """Formats reply latencies per command and stub service counters"""
+        lines = ["Reply latency by command:"]
+        for command in sorted(self.latencies.keys() | self.timeouts.keys()):
+            values = sorted(self.latencies[command])
+            line = f"- {command}: {len(values)} replies, {self.timeouts[command]} timeouts"
+            if values:
+                p50 = values[len(values) // 2]
+                p95 = values[min(len(values) - 1, int(len(values) * 0.95))]
+                line += f", p50 {p50 * 1000:.0f} ms, p95 {p95 * 1000:.0f} ms, max {values[-1] * 1000:.0f} ms"
+            lines.append(line)
+        lines.append("Stub services:")
+        for service in SERVICES.values():
+            lines.append(
+                f"- {service.name}: {service.calls} calls, {service.errors} errors, {service.throttled} rate limited"
+            )
+        lines.append(f"Bot API methods: {dict(self.server.sent)}")
+        return "\n".join(lines)
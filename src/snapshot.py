@@ -0,0 +1,342 @@
+import asyncio
+import dataclasses
+import glob
+import mmap
+import os
+import pickle
+import struct
+import time
+import zlib
+from datetime import date, datetime
+from typing import TYPE_CHECKING, Any, Callable, Dict, Iterable, List, Optional, Set, Tuple
+from aiogram.fsm.storage.base import StorageKey, StateType
+from aiogram.fsm.storage.memory import MemoryStorage, MemoryStorageRecord
+from config import logger, SNAPSHOT_FILE, SNAPSHOT_INTERVAL, JOURNAL_FLUSH_INTERVAL
+from models import DailyStats, UserProfile
+
+if TYPE_CHECKING:
+    from profile_cache import ProfileCache  # pylint: disable=cyclic-import (R0401)
+
+SNAPSHOT_MAGIC = b"FBSN"
+SNAPSHOT_VERSION = 1
+# magic, format version, generation, payload length, payload crc32
+SNAPSHOT_HEADER = struct.Struct("<4sHQQI")
+# record length, record crc32
+JOURNAL_HEADER = struct.Struct("<II")
+
+# Profiles and stats are stored as plain tuples, so snapshots don't depend on model classes
+PROFILE_FIELDS = ("weight", "height", "age", "activity_minutes", "city", "utc_offset")
+STATS_FIELDS = (
+    "day", "logged_water", "logged_calories", "burned_calories", "water_goal", "calorie_goal", "temperature"
+)
+
+
+def dump_stats(stats: DailyStats) -> Tuple:
+    """Converts daily stats to a plain tuple"""
+    return (*(getattr(stats, name) for name in STATS_FIELDS), list(stats.food_log), list(stats.workout_log))
+
+
+def load_stats(data: Tuple) -> DailyStats:
+    """Creates daily stats from a plain tuple"""
+    *values, food_log, workout_log = data
+    if isinstance(values[0], str):
+        # Stats saved before day numbers were introduced are keyed by ISO date
+        values[0] = date.fromisoformat(values[0]).toordinal()
+    return DailyStats(**dict(zip(STATS_FIELDS, values)), food_log=food_log, workout_log=workout_log)
+
+
+def dump_profile(profile: UserProfile, days: Optional[Iterable[int]] = None) -> Tuple:
+    """Converts profile to a plain tuple with stats of the given day numbers (all by default)"""
+    if days is None:
+        stats = profile.daily_stats.values()
+    else:
+        stats = [profile.daily_stats[day] for day in days if day in profile.daily_stats]
+    return (
+        profile.user_id,
+        tuple(getattr(profile, name) for name in PROFILE_FIELDS),
+        [dump_stats(s) for s in stats]
+    )
+
+
+def load_profile(data: Tuple, profile: Optional[UserProfile] = None) -> UserProfile:
+    """Creates profile from a plain tuple or applies the tuple to an existing profile"""
+    user_id, fields, stats = data
+    if profile is None:
+        profile = UserProfile(user_id=user_id)
+    # Profiles saved before a field was added keep its default value
+    for name, value in zip(PROFILE_FIELDS, fields):
+        setattr(profile, name, value)
+    for stats_data in stats:
+        day_stats = load_stats(stats_data)
+        profile.daily_stats[day_stats.day] = day_stats
+    return profile
+
+
+class JournaledMemoryStorage(MemoryStorage):
+    """FSM memory storage that reports every change, so it can be journaled"""
+    def __init__(self, on_change: Callable[[StorageKey], None]):
+        super().__init__()
+        self._on_change = on_change
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        await super().set_state(key, state)
+        self._on_change(key)
+
+    async def set_data(self, key: StorageKey, data) -> None:
+        await super().set_data(key, data)
+        self._on_change(key)
+
+
+class StateStore:  # pylint: disable=too-many-instance-attributes (R0902)
+    """
+    Persistence of user profiles and FSM state.
+    State is saved as periodic binary snapshots (versioned, checksummed, written atomically)
+    plus an append-only journal of changes since the last snapshot. Journal N holds changes
+    made after snapshot N, restore loads the snapshot and replays journals N, N+1, ...
+    Snapshots and journal records carry a sequence number of the profile cache, saved profiles
+    older than the row in the profile storage are skipped on restore.
+    """
+    def __init__(self, profiles: "ProfileCache", path: str = SNAPSHOT_FILE):
+        self._profiles = profiles
+        self.path = path
+        self.fsm_storage = JournaledMemoryStorage(self.mark_fsm_dirty)
+        self.generation = 0
+        self._journal = None
+        self._dirty_users: Dict[int, Set[int]] = {}  # user_id -> day numbers of changed stats
+        self._dirty_fsm: Set[StorageKey] = set()
+        self._lock = asyncio.Lock()
+        self._restored = False  # never overwrite saved state before it was loaded
+        self._listeners: List[Callable[[int, Set[int]], None]] = []
+        self._stored_versions: Dict[int, int] = {}  # versions of stored profiles, used during restore
+
+    def subscribe(self, listener: Callable[[int, Set[int]], None]):
+        """Registers a callback for user days marked as changed"""
+        self._listeners.append(listener)
+
+    def mark_dirty(self, user_id: int, days: Iterable[int]):
+        """Marks profile and its stats of the given day numbers as changed"""
+        days = set(days)
+        self._dirty_users.setdefault(user_id, set()).update(days)
+        for listener in self._listeners:
+            listener(user_id, days)
+
+    def mark_fsm_dirty(self, key: StorageKey):
+        """Marks FSM state of the key as changed"""
+        self._dirty_fsm.add(key)
+
+    def _journal_path(self, generation: int) -> str:
+        return f"{self.path}.journal.{generation}"
+
+    # Restore
+
+    def restore(self):
+        """Loads the last snapshot and replays journals written after it"""
+        start = time.monotonic()
+        self._stored_versions = self._profiles.stored_versions()
+        if os.path.exists(self.path):
+            try:
+                self.generation = self._load_snapshot()
+            except (OSError, ValueError, pickle.UnpicklingError) as e:
+                logger.error("Error loading snapshot %s: %s", self.path, e)
+                os.replace(self.path, self.path + ".corrupt")  # keep it for investigation
+
+        journals = []
+        for path in glob.glob(self._journal_path("*")):
+            generation = int(path.rsplit(".", 1)[1])
+            if generation >= self.generation:
+                journals.append((generation, path))
+        replayed = 0
+        for generation, path in sorted(journals):
+            replayed += self._replay_journal(path)
+            self.generation = generation
+
+        self._stored_versions = {}
+        self._restored = True
+        logger.info(
+            "Restored %s resident users, %s FSM states and %s journal records in %.2f s",
+            len(self._profiles.resident()), len(self.fsm_storage.storage), replayed, time.monotonic() - start
+        )
+
+    def _load_snapshot(self) -> int:
+        with open(self.path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            magic, version, generation, length, checksum = SNAPSHOT_HEADER.unpack_from(mm)
+            if magic != SNAPSHOT_MAGIC:
+                raise ValueError("Not a snapshot file")
+            if version != SNAPSHOT_VERSION:
+                raise ValueError(f"Unsupported snapshot version {version}")
+            with memoryview(mm) as view:
+                payload = view[SNAPSHOT_HEADER.size:SNAPSHOT_HEADER.size + length]
+                if len(payload) != length or zlib.crc32(payload) != checksum:
+                    payload.release()
+                    raise ValueError("Snapshot checksum mismatch")
+                state = pickle.loads(payload)
+                payload.release()
+
+        # Snapshots written before sequence numbers were introduced are always applied
+        sequence = state.get("sequence")
+        for profile_data in state["users"]:
+            self._apply_profile(profile_data, sequence)
+        for key, fsm_state, data in state["fsm"]:
+            self.fsm_storage.storage[StorageKey(**key)] = MemoryStorageRecord(data=data, state=fsm_state)
+        return generation
+
+    def _replay_journal(self, path: str) -> int:
+        replayed = 0
+        with open(path, "rb") as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return 0
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm, memoryview(mm) as view:
+                offset = 0
+                while offset + JOURNAL_HEADER.size <= len(view):
+                    length, checksum = JOURNAL_HEADER.unpack_from(view, offset)
+                    record = view[offset + JOURNAL_HEADER.size:offset + JOURNAL_HEADER.size + length]
+                    if len(record) != length or zlib.crc32(record) != checksum:
+                        record.release()
+                        break
+                    self._apply_record(pickle.loads(record))
+                    record.release()
+                    offset += JOURNAL_HEADER.size + length
+                    replayed += 1
+                if offset != len(view):
+                    # Tail of the journal was not fully written before the crash
+                    logger.warning("Journal %s is truncated at offset %s", path, offset)
+        return replayed
+
+    def _apply_profile(self, data: Tuple, sequence: Optional[int]):
+        user_id = data[0]
+        if sequence is not None:
+            self._profiles.advance_sequence(sequence + 1)
+            if sequence < self._stored_versions.get(user_id, 0):
+                # The profile was written to the storage after this state was saved
+                return
+        profile = self._profiles.peek(user_id)
+        if profile is None and user_id in self._profiles:
+            # Journal records hold only changed days, the rest of the history is in the profile storage
+            profile = self._profiles.load_stored(user_id)
+        self._profiles.put(load_profile(data, profile))
+
+    def _apply_record(self, record: Tuple):
+        kind, *data = record
+        if kind == "user":
+            # Records written before sequence numbers were introduced are always applied
+            self._apply_profile(data[0], data[1] if len(data) > 1 else None)
+        elif kind == "fsm":
+            key, fsm_state, fsm_data = data
+            self.fsm_storage.storage[StorageKey(**key)] = MemoryStorageRecord(data=fsm_data, state=fsm_state)
+
+    # Journal
+
+    def _drain(self) -> List[Tuple]:
+        """Takes changes made since the last call as journal records"""
+        records: List[Tuple] = []
+        dirty_users, self._dirty_users = self._dirty_users, {}
+        for user_id, days in dirty_users.items():
+            profile = self._profiles.peek(user_id)
+            if profile is not None:
+                records.append(("user", dump_profile(profile, days), self._profiles.next_sequence()))
+        dirty_fsm, self._dirty_fsm = self._dirty_fsm, set()
+        for key in dirty_fsm:
+            record = self.fsm_storage.storage.get(key)
+            if record is not None:
+                records.append(("fsm", dataclasses.asdict(key), record.state, dict(record.data)))
+        return records
+
+    @staticmethod
+    def _encode(records: List[Tuple]) -> bytes:
+        chunks = []
+        for record in records:
+            payload = pickle.dumps(record, protocol=pickle.HIGHEST_PROTOCOL)
+            chunks.append(JOURNAL_HEADER.pack(len(payload), zlib.crc32(payload)))
+            chunks.append(payload)
+        return b"".join(chunks)
+
+    async def flush(self):
+        """Appends pending changes to the journal"""
+        async with self._lock:
+            records = self._drain()
+            if not records or self._journal is None:
+                return
+            self._journal.write(self._encode(records))
+            self._journal.flush()
+            await asyncio.to_thread(os.fsync, self._journal.fileno())
+
+    # Snapshot
+
+    async def snapshot(self):
+        """Writes a full snapshot and starts a new journal"""
+        if not self._restored:
+            logger.warning("State was not restored, skipping snapshot")
+            return
+        async with self._lock:
+            # Changes made before this point are in the snapshot, after it - in the new journal
+            self._drain()
+            generation = self.generation + 1
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            if self._journal is not None:
+                self._journal.close()
+            self._journal = open(self._journal_path(generation), "ab")  # pylint: disable=consider-using-with (R1732)
+            self.generation = generation
+
+            state = {
+                "created": datetime.now().isoformat(),
+                "sequence": self._profiles.next_sequence(),
+                "users": [dump_profile(profile) for profile in self._profiles.resident()],
+                "fsm": [
+                    (dataclasses.asdict(key), record.state, dict(record.data))
+                    for key, record in list(self.fsm_storage.storage.items())
+                    if record.state is not None or record.data
+                ],
+            }
+            try:
+                await asyncio.to_thread(self._write_snapshot, state, generation)
+            except Exception as e:
+                logger.error("Error writing snapshot: %s", e)
+
+    def _write_snapshot(self, state: Dict[str, Any], generation: int):
+        start = time.monotonic()
+        payload = pickle.dumps(state, protocol=pickle.HIGHEST_PROTOCOL)
+        header = SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, generation, len(payload), zlib.crc32(payload))
+
+        # Write to a temporary file and rename it, so the snapshot is never partially written
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(header)
+            f.write(payload)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+        directory = os.open(os.path.dirname(os.path.abspath(self.path)), os.O_RDONLY)
+        try:
+            os.fsync(directory)
+        finally:
+            os.close(directory)
+
+        # Journals before this snapshot are not needed anymore
+        for path in glob.glob(self._journal_path("*")):
+            if int(path.rsplit(".", 1)[1]) < generation:
+                os.remove(path)
+        logger.info(
+            "Snapshot %s written: %s users, %s bytes in %.2f s",
+            generation, len(state["users"]), len(payload), time.monotonic() - start
+        )
+
+    async def run(self):
+        """Flushes the journal and takes snapshots periodically until cancelled"""
+        last_snapshot = time.monotonic()
+        while True:
+            await asyncio.sleep(JOURNAL_FLUSH_INTERVAL)
+            try:
+                if time.monotonic() - last_snapshot >= SNAPSHOT_INTERVAL:
+                    await self.snapshot()
+                    last_snapshot = time.monotonic()
+                else:
+                    await self.flush()
+            except Exception as e:
+                logger.error("Error saving state: %s", e)
+
+    async def close(self):
+        """Takes the final snapshot"""
+        await self.snapshot()
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
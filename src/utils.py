@@ -1,14 +1,15 @@
+import asyncio
 import io
 from typing import Optional, Dict
 import aiohttp
-import matplotlib.pyplot as plt
+from matplotlib.figure import Figure
 from fatsecret import Fatsecret
 from models import DailyStats  # pylint: disable=cyclic-import (R0401)
-from config import logger, CONSUMER_KEY, CONSUMER_SECRET
+from config import logger, CONSUMER_KEY, CONSUMER_SECRET, SIMULATION, WEATHER_API_URL
 
 
-async def get_temperature(city: str, api_key: str) -> Optional[float]:
-    """Gets temperature for a city using OpenWeatherMap API
+async def get_weather(city: str, api_key: str) -> Optional[Dict]:
+    """Gets temperature and UTC offset (seconds) of a city using OpenWeatherMap API
         Example response for Moscow:
             {
                 "coord": {"lon": 37.6156, "lat": 55.7522},
@@ -34,16 +35,17 @@ async def get_temperature(city: str, api_key: str) -> Optional[float]:
                     "sunrise": 1737179143,
                     "sunset": 1737207226
                 },
+                "timezone": 10800,
                 "name": "Moscow",
                 "cod": 200
             }
     """
-    url = f"http://api.openweathermap.org/data/2.5/weather?q={city}&appid={api_key}&units=metric"
+    params = {"q": city, "appid": api_key or "", "units": "metric"}
     async with aiohttp.ClientSession() as session:
-        async with session.get(url) as response:
+        async with session.get(WEATHER_API_URL, params=params) as response:
             if response.status == 200:
                 data = await response.json()
-                return data["main"]["temp"]
+                return {"temperature": data["main"]["temp"], "utc_offset": data.get("timezone", 0)}
             logger.error("Error getting temperature: %s", response.status)
     return None
 
@@ -118,11 +120,17 @@ async def get_food_info_from_fs(product_name: str) -> Optional[Dict]:
     }
     """
     try:
-        # Initialize FatSecret client
-        fs = Fatsecret(CONSUMER_KEY, CONSUMER_SECRET)
+        # Initialize FatSecret client, the stub one works offline with simulated latency and outages
+        if SIMULATION:
+            from simulation import StubFatsecret  # pylint: disable=import-outside-toplevel (C0415)
+            fs = StubFatsecret()
+        else:
+            fs = Fatsecret(CONSUMER_KEY, CONSUMER_SECRET)
 
         # Search for food. ENGLISH ONLY!
-        search_results = fs.foods_search(product_name)  # region="RU", language="ru") - only in paid version
+        # FatSecret client is blocking, so requests are made in a thread to keep the event loop responsive
+        # region="RU", language="ru") - only in paid version
+        search_results = await asyncio.to_thread(fs.foods_search, product_name)
 
         if not search_results:
             logger.warning("Food not found: %s", product_name)
@@ -132,7 +140,7 @@ async def get_food_info_from_fs(product_name: str) -> Optional[Dict]:
         food_id = search_results[0]['food_id']
 
         # Get detailed food information
-        food_details = fs.food_get_v2(food_id)
+        food_details = await asyncio.to_thread(fs.food_get_v2, food_id)
 
         if not food_details or 'servings' not in food_details:
             logger.warning("No serving information for food: %s", product_name)
@@ -182,8 +190,15 @@ async def get_food_info_from_fs(product_name: str) -> Optional[Dict]:
 
 async def generate_progress_charts(stats: DailyStats) -> io.BytesIO:
     """Generates progress charts for water and calories"""
-    # Create figure with two subplots
-    fig, (ax1, ax2) = plt.subplots(2, 1, figsize=(10, 12))
+    # Rendering is CPU-bound, so it runs in a thread to keep the event loop responsive
+    return await asyncio.to_thread(render_progress_charts, stats)
+
+
+def render_progress_charts(stats: DailyStats) -> io.BytesIO:
+    """Renders progress charts for water and calories"""
+    # Create figure with two subplots. Figure is used instead of pyplot, which is not thread-safe
+    fig = Figure(figsize=(10, 12))
+    ax1, ax2 = fig.subplots(2, 1)
     fig.patch.set_facecolor('#F0F2F6')
 
     # Colors for charts
@@ -220,12 +235,11 @@ async def generate_progress_charts(stats: DailyStats) -> io.BytesIO:
         ax.grid(axis='y', linestyle='--', alpha=0.7)
         ax.set_facecolor('#F0F2F6')
 
-    plt.tight_layout()
+    fig.tight_layout()
 
     # Save chart to buffer
     buf = io.BytesIO()
-    plt.savefig(buf, format='png', dpi=300, bbox_inches='tight')
+    fig.savefig(buf, format='png', dpi=300, bbox_inches='tight')
     buf.seek(0)
-    plt.close()
 
     return buf